@@ -1,21 +1,12 @@
+import atexit
 import json
 import logging
-import os
 import sys
 import time
-from pprint import pprint
-from typing import Any, Literal
 import re
-from copy import deepcopy as copy
+from typing import Iterator
 
-import requests
-from slack_bolt import App
-from slack_bolt.adapter.socket_mode import SocketModeHandler
-from slack_sdk.web.client import WebClient  # for typing
-from slack_sdk.web.slack_response import SlackResponse  # for typing
-
-from util import formatters, misc, slackUtils, tidyhq, blocks
-from editable_resources import strings
+from util import ledger, leader, tidyhq
 
 # Split up command line arguments
 # -v: verbose logging
@@ -50,10 +41,54 @@ logger = logging.getLogger("main loop")
 slack_logger = logging.getLogger("slack_bolt")
 slack_logger.setLevel(logging.INFO)
 
-# Connect to Slack
-app = App(token=config["slack"]["bot_token"], logger=slack_logger)
+if "-c" not in sys.argv:
+    logger.info(
+        "Nothing to do, run with -c to check for sign offs that need a follow up"
+    )
+else:
+    # When several instances share a lease database only the first cron run in each period sends follow ups
+    if config.get("leader_lease") and not leader.claim(
+        path=config["leader_lease"],
+        name="checkin",
+        period=config.get("cron_claim_period", 3600),
+    ):
+        sys.exit(0)
+
+    # If this run fails let another instance's cron have a go, rather than skipping follow ups until the claim runs out
+    finished = False
+
+    def release_unfinished() -> None:
+        if not finished:
+            leader.release(path=config["leader_lease"], name="checkin")
+
+    if config.get("leader_lease"):
+        atexit.register(release_unfinished)
+
+    # Slack is slow to import so it's only loaded once we know this run has work to do
+    from slack_bolt import App
+
+    from util import fanout, ratelimit, slackUtils
+
+    # Connect to Slack
+    app = App(token=config["slack"]["bot_token"], logger=slack_logger)
+
+    def paged_messages(method: str, **kwargs) -> Iterator[dict]:
+        """Yield the messages from conversations.history or conversations.replies, following the cursor through every page."""
+        cursor = None
+        while True:
+            response = ratelimit.call(
+                app.client,
+                method,
+                priority="background",
+                cursor=cursor,
+                limit=200,
+                **kwargs,
+            )
+            yield from response["messages"]
+            cursor = (response.get("response_metadata") or {}).get("next_cursor")
+            if not response.get("has_more") or not cursor:
+                return
 
-if "-c" in sys.argv:
     logging.info("Running in cron mode, will check for sign offs that need a follow up")
 
     # Compile a list of machine operator groups
@@ -79,79 +114,159 @@ if "-c" in sys.argv:
         current_time - (current_time % 86400) - longest_check_in * 86400
     )
     print(longest_check_in_timestamp)
+
+    # Machine names longest first so a name that contains another (eg "Lathe 🅿️" and "Lathe") matches the right one
+    machines_by_name = sorted(
+        machine_groups.values(), key=lambda group: len(group["name"]), reverse=True
+    )
+    operator_patten = re.compile(r"\(<@(\w+)>\)")
+    trainer_pattern = re.compile(r"by <@(\w*)>")
+
+    def read_sign_off(message: dict) -> dict | None:
+        """The trainer, operator and machine group IDs of a sign off notification, or None for other messages."""
+        metadata = message.get("metadata") or {}
+        if metadata.get("event_type") == "training_add":
+            payload = metadata["event_payload"]
+            # The operator is a TidyHQ contact ID
+            contact = tidyhq.get_contact(contact_id=payload["operator"], cache=cache)
+            if contact:
+                operator = contact["slack_mention"] or contact["display_name"]
+            else:
+                operator = f"TidyHQ contact {payload['operator']}"
+            return {
+                "trainer": payload["trainer"],
+                "operator": operator,
+                "contact": payload["operator"],
+                "machines": payload.get("machines") or [payload["machine"]],
+            }
+
+        # Messages sent before sign offs had metadata have to be read from their text
+        text = message.get("text", "")
+        if metadata or "has been authorised" not in text:
+            return None
+        trainer_search = trainer_pattern.search(text)
+        if not trainer_search:
+            logging.warning("No trainer found in message")
+            return None
+        operator_search = operator_patten.search(text)
+        for machine in machines_by_name:
+            if machine["name"] in text:
+                return {
+                    "trainer": trainer_search.group(1),
+                    "operator": (
+                        f"<@{operator_search.group(1)}>" if operator_search else "them"
+                    ),
+                    "machines": [machine["id"]],
+                    "contact": None,
+                }
+        return None
+
+    ledger_path = config.get("sign_off_ledger", "sign_offs.db")
+
     # Check recent messages for sign offs that need to be checked in
-    response = app.client.conversations_history(
+    scan_start = time.time()
+    scanned = 0
+    due = []
+    for message in paged_messages(
+        "conversations.history",
         channel=config["slack"]["notification_channel"],
         oldest=str(longest_check_in_timestamp),
-    )
-    messages = response["messages"]
-    logging.info(
-        f"Found {len(messages)} messages in channel {config['slack']['notification_channel']} in the last {longest_check_in} days"
-    )
+        include_all_metadata=True,
+    ):
+        scanned += 1
 
-    for message in messages:
-        # Confirm the message is a sign off
-        if "has been authorised" not in message["text"]:
+        sign_off = read_sign_off(message)
+        if not sign_off:
             continue
 
-        for machine in machine_groups:
-            if machine_groups[machine]["name"] in message["text"]:
-                logging.debug(
-                    f"Found a message about {machine_groups[machine]['name']}"
+        # Check if the sign off occurred on the correct day for any of its machines
+        sign_off_days_ago = (current_time - int(float(message["ts"]))) // 86400 + 1
+        due_machines = []
+        for machine_id in sign_off["machines"]:
+            machine = machine_groups.get(int(machine_id))
+            if not machine or int(machine["first_use_check_in"]) != sign_off_days_ago:
+                continue
+            # The bot sends reminders itself for sign offs in its ledger
+            if (
+                ledger_path
+                and sign_off["contact"]
+                and ledger.recorded(
+                    ledger_path, operator=sign_off["contact"], machine=machine_id
                 )
+            ):
+                logging.debug(f"Sign off for {machine['name']} is in the ledger")
+                continue
+            due_machines.append((int(machine_id), machine["name"]))
+        if not due_machines:
+            continue
+
+        logging.debug(
+            f"Sign off for {', '.join(name for _, name in due_machines)} occurred {sign_off_days_ago} days ago, which is the correct day"
+        )
+        due.append(
+            {
+                "ts": message["ts"],
+                "machines": due_machines,
+                "days": sign_off_days_ago,
+                "trainer": sign_off["trainer"],
+                "operator": sign_off["operator"],
+            }
+        )
+
+    scan_time = time.time() - scan_start
+    logging.info(
+        f"Scanned {scanned} messages in channel {config['slack']['notification_channel']} from the last {longest_check_in} days in {scan_time:.1f}s ({scanned / max(scan_time, 0.001):.1f}/s), {len(due)} sign offs are due a check in"
+    )
+
+    def follow_up(sign_off: dict) -> None:
+        # Look for replies to the message that indicate which machines have already been checked on
+        checked = set()
+        for reply in paged_messages(
+            "conversations.replies",
+            channel=config["slack"]["notification_channel"],
+            ts=sign_off["ts"],
+            include_all_metadata=True,
+        ):
+            metadata = reply.get("metadata") or {}
+            if metadata.get("event_type") == "training_check_in":
+                checked.add(int(metadata["event_payload"]["machine"]))
+                continue
+
+            # Check ins sent before they had metadata don't say which machine they were for
+            text = reply.get("text", "")
+            if len(sign_off["machines"]) == 1 and (
+                "This induction was confirmed by" in text
+                or "This induction was removed by" in text
+            ):
+                checked.add(sign_off["machines"][0][0])
 
-                # Check if the sign off occurred on the correct day
-                sign_off_days_ago = (
-                    current_time - int(float(message["ts"]))
-                ) // 86400 + 1
-                if sign_off_days_ago == int(
-                    machine_groups[machine]["first_use_check_in"]
-                ):
-                    pprint(message["text"])
-                    logging.debug(
-                        f"Sign off occurred {sign_off_days_ago} days ago, which is the correct day"
-                    )
-                    operator_patten = re.compile(r"\(<@(\w+)>\)")
-                    trainer_pattern = re.compile(r"by <@(\w*)>")
-
-                    operator_search = operator_patten.search(message["text"])
-                    trainer_search = trainer_pattern.search(message["text"])
-
-                    if operator_search:
-                        operator = operator_search.group(1)
-
-                    if trainer_search:
-                        trainer = trainer_search.group(1)
-
-                    if not trainer:
-                        logging.warning("No trainer found in message")
-                        continue
-
-                    # Look for replies to the message that indicate that the sign off has already been checked on
-
-                    replies = app.client.conversations_replies(
-                        channel=config["slack"]["notification_channel"],
-                        ts=message["ts"],
-                    )
-
-                    for reply in replies["messages"]:
-                        if (
-                            "This induction was confirmed by" in reply["text"]
-                            or "This induction was removed by" in reply["text"]
-                        ):
-                            logging.debug("This sign off has already been checked")
-                            break
-                    else:
-                        # If no replies indicate that the sign off has been checked, send a message to the trainer
-                        logging.info(
-                            f"Sending a message to <@{trainer}> to follow up with <@{operator}>"
-                        )
-                        slackUtils.send(
-                            app=app,
-                            channel=config["slack"]["notification_channel"],
-                            thread_ts=message["ts"],
-                            message=f"Hey <@{trainer}>, can you please follow up with <@{operator}> about their recent sign off for {machine_groups[machine]['name']}? It's been {sign_off_days_ago} days since the sign off.",
-                        )
-
-                        # An auth will only match one machine
-                        break
+        machine = ", ".join(
+            name
+            for machine_id, name in sign_off["machines"]
+            if machine_id not in checked
+        )
+        if not machine:
+            logging.debug("This sign off has already been checked")
+            return
+
+        # If no replies indicate that the sign off has been checked, send a message to the trainer
+        logging.info(
+            f"Sending a message to <@{sign_off['trainer']}> to follow up with {sign_off['operator']}"
+        )
+        slackUtils.send(
+            app=app,
+            channel=config["slack"]["notification_channel"],
+            thread_ts=sign_off["ts"],
+            message=f"Hey <@{sign_off['trainer']}>, can you please follow up with {sign_off['operator']} about their recent sign off for {machine}? It's been {sign_off['days']} days since the sign off.",
+            priority="background",
+        )
+
+    # Replies are only fetched for sign offs that are due, several at a time within the rate limit
+    done, failed = fanout.run(
+        items=due,
+        work=follow_up,
+        workers=config.get("checkin_workers", 4),
+        label="due sign offs",
+    )
+    finished = not failed
+    sys.exit(1 if failed else 0)
@@ -54,6 +54,10 @@ Please indicate:
 checkin_induction_approved = "Your {} induction has been maintained. Unless something changes about the tool or we identify it's been a long time since you've used it I won't contact you about it again."
 checkin_induction_rejected = "Unfortunately your {} induction has been revoked. Please arrange with a trainer to undergo a refresher induction before using this tool again."
 
+profile_trainers_only = "Only trainers can turn on profiling."
+profile_status = "Profiling {}. Dumps are written to `{}` on the bot host. Use `off` to stop profiling everything, or `off <name>` to stop one."
+profile_off = "Profiling is off. Add handler or task names (eg `add_training`, `tool_selector_modal`, `cache_refresh` or `all`) to start."
+
 tidyhq_update_complete = (
     "Data updated from TidyHQ in {:.1f} seconds. (You can close this message)"
 )
@@ -77,3 +81,4 @@ As a recap of what was covered, you should now be familiar with:
 
 If you have any questions about any of this, feel free to reach out to our Membership Officer <@UC6T4U150> or any committee member.
 """
+render_failed = "Sorry, something went wrong loading this. Please try again."
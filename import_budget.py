@@ -0,0 +1,87 @@
+# Check that the cron scripts load quickly by timing their imports with python -X importtime
+# Usage: import_budget.py [-v] (-v lists the slowest imports for each script)
+# Exits with 1 if a script's imports go over its budget or load a module it only needs on other paths
+
+import ast
+import subprocess
+import sys
+
+# Import time budget in milliseconds for each script, and modules it shouldn't load until a path needs them
+budgets: dict[str, tuple[float, list[str]]] = {
+    "checkin.py": (60, ["slack_bolt", "slack_sdk", "requests", "pprint"]),
+    "refresh_cache.py": (60, ["slack_bolt", "slack_sdk", "requests", "pprint"]),
+    "markdown_report.py": (60, ["slack_bolt", "slack_sdk", "requests", "pprint"]),
+    "report.py": (60, ["slack_bolt", "slack_sdk", "requests", "pprint"]),
+}
+
+# Timings vary from run to run so each script is measured a few times and the fastest run is used
+runs = 3
+
+
+def top_level_imports(script: str) -> str:
+    """The script's module level import statements, so they can be timed without running the script."""
+    with open(script) as f:
+        tree = ast.parse(f.read())
+    return "\n".join(
+        ast.unparse(node)
+        for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom))
+    )
+
+
+def measure(code: str) -> dict[str, tuple[float, bool]]:
+    """Import time in milliseconds and whether it was imported directly for each module loaded by code."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip() == "cumulative":
+            continue
+        # Nested imports are indented under the module that imported them
+        modules[name.strip()] = (
+            int(cumulative) / 1000,
+            not name[1:].startswith(" "),
+        )
+    return modules
+
+
+# Modules loaded by the interpreter itself before any script code runs
+startup = measure("pass")
+
+over = False
+for script, (budget, deferred) in budgets.items():
+    code = top_level_imports(script)
+    fastest = None
+    for _ in range(runs):
+        modules = {
+            name: timing
+            for name, timing in measure(code).items()
+            if name not in startup
+        }
+        total = sum(ms for ms, direct in modules.values() if direct)
+        if fastest is None or total < fastest[0]:
+            fastest = (total, modules)
+    total, modules = fastest  # type: ignore
+
+    loaded = [name for name in deferred if name in modules]
+    status = "ok"
+    if total > budget or loaded:
+        status = "OVER BUDGET" if total > budget else "LOADS DEFERRED MODULES"
+        over = True
+    print(f"{script}: {total:.1f}ms of {budget}ms, {len(modules)} modules ({status})")
+    if loaded:
+        print(f"  Loads {', '.join(loaded)} on every run")
+
+    if "-v" in sys.argv or status != "ok":
+        slowest = sorted(modules.items(), key=lambda item: item[1][0], reverse=True)
+        for name, (ms, _) in slowest[:10]:
+            print(f"  {ms:8.1f}ms {name}")
+
+sys.exit(1 if over else 0)
@@ -0,0 +1,202 @@
+# Load test the Slack bot in HTTP mode against a local stand-in for the Slack API
+#
+# 1. Start the Slack API stand-in: ./load_test.py stub --port 8089
+# 2. Set slack.api_base_url to http://127.0.0.1:8089/api/ and slack.signing_secret in config.json
+# 3. Start the bot: gunicorn --workers 4 --bind 127.0.0.1:3000 wsgi:app
+# 4. Send it signed payloads: ./load_test.py run --url http://127.0.0.1:3000/slack/events --stub http://127.0.0.1:8089
+
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode
+
+import requests
+from slack_sdk.signature import SignatureVerifier
+
+from util import tidyhq
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("load_test")
+
+# Slack API stand-in
+
+# Just enough of each response for the bot to carry on
+stub_responses = {
+    "auth.test": {"user": "load_test", "team": "Load Test", "user_id": "UBOT"},
+    "chat.postMessage": {"ts": "1700000000.000100", "channel": "C1"},
+    "conversations.open": {"channel": {"id": "D1"}},
+    "users.info": {"user": {"profile": {"display_name": "Load Test"}}},
+    "users.list": {"members": []},
+    "usergroups.list": {"usergroups": []},
+    "views.open": {"view": {"id": "V1"}},
+    "views.push": {"view": {"id": "V1"}},
+    "views.update": {"view": {"id": "V1"}},
+}
+
+stub_calls: dict[str, int] = {}
+stub_lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        method = self.path.rsplit("/", 1)[-1]
+        with stub_lock:
+            stub_calls[method] = stub_calls.get(method, 0) + 1
+        time.sleep(self.latency)
+        self._reply({"ok": True, **stub_responses.get(method, {})})
+
+    def do_GET(self):
+        # Call counts so the load test can report on what the bot did
+        with stub_lock:
+            self._reply(dict(stub_calls))
+
+    def _reply(self, data: dict):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_stub(port: int, latency: float) -> None:
+    StubHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    logger.info(f"Slack API stand-in listening on http://127.0.0.1:{port}/api/")
+    server.serve_forever()
+
+
+# Payload simulator
+
+
+def home_opened(user: str) -> tuple[str, str]:
+    body = {
+        "type": "event_callback",
+        "team_id": "T1",
+        "api_app_id": "A1",
+        "event": {
+            "type": "app_home_opened",
+            "user": user,
+            "channel": "D1",
+            "tab": "home",
+            "event_ts": str(time.time()),
+        },
+        "event_id": "Ev" + uuid.uuid4().hex[:10],
+        "event_time": int(time.time()),
+    }
+    return json.dumps(body), "application/json"
+
+
+def category_pressed(user: str) -> tuple[str, str]:
+    payload = {
+        "type": "block_actions",
+        "team": {"id": "T1"},
+        "user": {"id": user},
+        "api_app_id": "A1",
+        "trigger_id": uuid.uuid4().hex,
+        "container": {"type": "view", "view_id": "V1"},
+        "actions": [
+            {
+                "type": "button",
+                "block_id": "check_training",
+                "action_id": "category-all",
+                "value": "all",
+                "action_ts": str(time.time()),
+            }
+        ],
+    }
+    return (
+        urlencode({"payload": json.dumps(payload)}),
+        "application/x-www-form-urlencoded",
+    )
+
+
+def run_load(args, config: dict) -> None:
+    # Use real linked users so homes and modals are fully rendered
+    cache = tidyhq.fresh_cache(config=config)
+    users = list(tidyhq.index(cache=cache, config=config)["slack"]) or ["ULOADTEST"]
+    logger.info(f"Sending payloads as {len(users)} users")
+
+    signer = SignatureVerifier(signing_secret=config["slack"]["signing_secret"])
+    scenarios = [home_opened, category_pressed]
+
+    def send(_):
+        body, content_type = random.choice(scenarios)(random.choice(users))
+        timestamp = str(int(time.time()))
+        start = time.time()
+        r = requests.post(
+            args.url,
+            data=body,
+            headers={
+                "Content-Type": content_type,
+                "X-Slack-Request-Timestamp": timestamp,
+                "X-Slack-Signature": signer.generate_signature(
+                    timestamp=timestamp, body=body
+                ),
+            },
+        )
+        return time.time() - start, r.status_code
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(send, range(args.requests)))
+    elapsed = time.time() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    failed = sum(1 for _, status in results if status != 200)
+
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+    print(
+        f"{len(results)} payloads in {elapsed:.1f}s ({len(results) / elapsed:.1f}/s), {failed} failed"
+    )
+    print(
+        f"Ack latency p50 {percentile(0.5):.3f}s, p95 {percentile(0.95):.3f}s, p99 {percentile(0.99):.3f}s, max {latencies[-1]:.3f}s"
+    )
+
+    if args.stub:
+        # Give background rendering a moment to finish before counting what the bot sent
+        time.sleep(args.settle)
+        print("Slack API calls made by the bot:")
+        for method, count in sorted(requests.get(args.stub).json().items()):
+            print(f"  {method}: {count}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stub_parser = subparsers.add_parser("stub", help="Run the Slack API stand-in")
+    stub_parser.add_argument("--port", type=int, default=8089)
+    stub_parser.add_argument(
+        "--latency", type=float, default=0.05, help="Seconds to wait per API call"
+    )
+
+    run_parser = subparsers.add_parser("run", help="Send signed payloads to the bot")
+    run_parser.add_argument("--url", default="http://127.0.0.1:3000/slack/events")
+    run_parser.add_argument("--stub", help="URL of the Slack API stand-in")
+    run_parser.add_argument("--requests", type=int, default=200)
+    run_parser.add_argument("--concurrency", type=int, default=20)
+    run_parser.add_argument("--settle", type=float, default=5)
+
+    args = parser.parse_args()
+
+    if args.command == "stub":
+        run_stub(port=args.port, latency=args.latency)
+    else:
+        with open("config.json") as f:
+            run_load(args=args, config=json.load(f))
@@ -3,10 +3,8 @@
 import os
 import sys
 import json
-import requests
 import datetime
 import logging
-from pprint import pprint
 from typing import Any
 
 from util import tidyhq, machines
@@ -4,10 +4,8 @@ import os
 import sys
 import json
 import datetime
-import requests
 from util import tidyhq
 from util import tidyauth  # type: ignore
-from pprint import pprint
 import logging
 
 # Set up logging
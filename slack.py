@@ -1,23 +1,58 @@
+import concurrent.futures
 import json
 import logging
 import os
 import re
 import sys
+import threading
 import time
 from copy import deepcopy as copy
 from datetime import datetime
-from pprint import pprint
-from typing import Any, Literal
+from typing import Any, Callable, Literal
 
-import requests
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from slack_sdk.web.client import WebClient  # for typing
 from slack_sdk.web.slack_response import SlackResponse  # for typing
 
-from util import blocks, formatters, misc, slackUtils, tidyhq, machines
+from util import (
+    blocks,
+    fanout,
+    followups,
+    formatters,
+    leader,
+    misc,
+    outbox,
+    profiling,
+    ratelimit,
+    search,
+    slackUtils,
+    snapshot,
+    tidyhq,
+    machines,
+    metrics,
+    tracing,
+    webhooks,
+    workers,
+)
 from editable_resources import strings
 
+# Time each part of startup so slow restarts can be narrowed down
+startup_started = time.time()
+startup_timings: list[tuple[str, float]] = []
+
+
+def startup_step(name: str) -> None:
+    """Record how long a startup step took since the previous one."""
+    elapsed = time.time() - startup_started - sum(t for _, t in startup_timings)
+    startup_timings.append((name, elapsed))
+
+
+def log_startup_timings() -> None:
+    breakdown = ", ".join(f"{name} {elapsed:.2f}s" for name, elapsed in startup_timings)
+    logger.info(f"Started in {time.time() - startup_started:.2f}s ({breakdown})")
+
+
 # Split up command line arguments
 # -v: verbose logging
 # -c: cron job
@@ -32,6 +67,9 @@ if "-cv" in sys.argv or "-vc" in sys.argv:
 with open("config.json", "r") as config_file:
     config = json.load(config_file)
 
+# Sign offs waiting for a follow up reminder (see util/ledger.py), set sign_off_ledger to "" to turn reminders off
+ledger_path = config.get("sign_off_ledger", "sign_offs.db")
+
 # Set up root logger
 root_logger = logging.getLogger()
 if "-v" in sys.argv:
@@ -44,42 +82,162 @@ root_logger.addHandler(ch)
 
 # Set up loop logging
 logger = logging.getLogger("main loop")
+startup_step("config")
 
 # Changing logging level for slack_bolt to info
 slack_logger = logging.getLogger("slack_bolt")
 slack_logger.setLevel(logging.INFO)
 
 # Connect to Slack
-app = App(token=config["slack"]["bot_token"], logger=slack_logger)
+# signing_secret is only needed in HTTP mode (see wsgi.py). api_base_url can point at a local stand-in for the Slack API (see load_test.py)
+app = App(
+    client=WebClient(
+        token=config["slack"]["bot_token"],
+        base_url=config["slack"].get("api_base_url", WebClient.BASE_URL),
+    ),
+    signing_secret=config["slack"].get("signing_secret"),
+    logger=slack_logger,
+)
+startup_step("slack app")
 
+# Write spans for each incoming payload if config["trace_file"] is set
+tracing.configure(config)
 
-# Update the app home in certain circumstances
-@app.event("app_home_opened")  # type: ignore
-def app_home_opened(event: dict[str, Any], client: WebClient, ack) -> None:
-    ack()
+# Handlers, worker tasks or "cache_refresh" to profile from startup, trainers can change this with the profile command
+if config.get("profile"):
+    profiling.enable(config["profile"])
+
+
+def open_rendered_modal(
+    trigger_id: str, render: Callable[[], dict], handler: str, push: bool = False
+) -> None:
+    """Open the modal produced by render().
+
+    If the cache is fresh we give render() config["render_budget"] seconds (default 0.5) on the worker pool and open the finished modal directly. Otherwise, or if rendering takes longer, a placeholder modal is opened and updated once render() is done.
+    """
+    open_method = "views.push" if push else "views.open"
+
+    def traced_render():
+        with tracing.span("render", handler=handler):
+            return render()
+
+    def render_failed_modal():
+        return formatters.placeholder_modal(
+            text=strings.render_failed, title="Something went wrong"
+        )
+
+    def open_view(view):
+        return ratelimit.call(app.client, open_method, trigger_id=trigger_id, view=view)
+
+    start = time.time()
+
+    # A cache refresh means a TidyHQ download so don't bother trying the fast path
+    if workers.enabled() and not tidyhq.is_stale(cache=cache, config=config):
+        future = workers.submit(handler, traced_render)
+        try:
+            view = future.result(timeout=config.get("render_budget", 0.5))
+        except concurrent.futures.TimeoutError:
+            logger.info(
+                f"{handler} took longer than the render budget, opening placeholder"
+            )
+        except Exception:
+            # Already logged by the worker pool, tell the user rather than leaving them with nothing
+            open_view(view=render_failed_modal())
+            return
+        else:
+            open_view(view=view)
+            metrics.observe(
+                "modal_render_seconds",
+                time.time() - start,
+                handler=handler,
+                path="direct",
+            )
+            logger.info(
+                f"{handler} opened rendered modal directly in {time.time() - start:.2f}s"
+            )
+            return
+    else:
+        logger.info(f"{handler} needs a refresh, opening placeholder")
+        future = None
+
+    # Send a placeholder modal while we gather data
+    v = open_view(view=formatters.placeholder_modal())
+
+    def update(view):
+        ratelimit.call(
+            app.client,
+            "views.update",
+            view_id=v["view"]["id"],  # type: ignore
+            view=view,
+        )
+        metrics.observe(
+            "modal_render_seconds",
+            time.time() - start,
+            handler=handler,
+            path="placeholder",
+        )
+
+    if future:
+        # Pick up the render that's already running
+        def update_when_done(done):
+            update(render_failed_modal() if done.exception() else done.result())
+
+        future.add_done_callback(update_when_done)
+    else:
+
+        def render_and_update():
+            try:
+                view = traced_render()
+            except Exception:
+                update(render_failed_modal())
+                raise
+            update(view)
+
+        workers.submit(handler, render_and_update)
+
+
+def refresh_and_update_home(user: str, client: WebClient) -> None:
     global cache
     cache = tidyhq.fresh_cache(cache=cache, config=config)
     slackUtils.updateHome(
-        user=event["user"],
+        user=user,
         client=client,
         config=config,
         cache=cache,
         machine_raw=machine_list,
-    )  # type: ignore
+    )
+
+
+# Update the app home in certain circumstances
+@app.event("app_home_opened")  # type: ignore
+@metrics.handler
+def app_home_opened(event: dict[str, Any], client: WebClient, ack) -> None:
+    ack()
+    workers.submit("app_home_opened", refresh_and_update_home, event["user"], client)
 
 
 @app.action("refresh_home")
+@metrics.handler
 def refresh_home(ack, body, client):
     ack()
-    global cache
-    cache = tidyhq.fresh_cache(cache=cache, config=config)
-    slackUtils.updateHome(
-        user=body["user"]["id"],
-        client=client,
-        config=config,
-        cache=cache,
-        machine_raw=machine_list,
-    )
+    workers.submit("refresh_home", refresh_and_update_home, body["user"]["id"], client)
+
+
+# Trainer group membership has changed
+@app.event("subteam_members_changed")
+@metrics.handler
+def subteam_members_changed(ack, event):
+    ack()
+    logger.debug(f"Membership of user group {event.get('subteam_id')} changed")
+    slackUtils.invalidate_trainers()
+
+
+@app.event("subteam_updated")
+@metrics.handler
+def subteam_updated(ack, event):
+    ack()
+    logger.debug(f"User group {event.get('subteam', {}).get('id')} updated")
+    slackUtils.invalidate_trainers()
 
 
 # Category buttons
@@ -87,48 +245,36 @@ cat_pattern = re.compile("category-.*")
 
 
 @app.action({"block_id": "check_training", "action_id": cat_pattern})
+@metrics.handler
 def check_own_training(ack, body, client):
     ack()
 
-    # Send a placeholder modal while we gather data
-    v = app.client.views_open(
-        trigger_id=body["trigger_id"],
-        view=formatters.placeholder_modal(),
-    )
-
-    global cache
-    cache = tidyhq.fresh_cache(cache=cache, config=config)
-
     # Get the category from the action ID
     category = body["actions"][0]["value"]
 
-    modal = formatters.authed_machines_modal(
-        user=body["user"]["id"],
-        config=config,
-        client=client,
-        cache=cache,
-        categories=[category],
-        machine_list=machine_list,
-    )
-    app.client.views_update(
-        view_id=v["view"]["id"],  # type: ignore
-        view=modal,
+    def render():
+        global cache
+        cache = tidyhq.fresh_cache(cache=cache, config=config)
+
+        return formatters.authed_machines_modal(
+            user=body["user"]["id"],
+            config=config,
+            client=client,
+            cache=cache,
+            categories=[category],
+            machine_list=machine_list,
+        )
+
+    open_rendered_modal(
+        trigger_id=body["trigger_id"], render=render, handler="check_own_training"
     )
 
 
 @app.view("filter_authed_tools_modal")
+@metrics.handler
 def filter_authed_tools_modal(ack, body, client):
     ack()
 
-    # Send a placeholder modal while we gather data
-    v = app.client.views_open(
-        trigger_id=body["trigger_id"],
-        view=formatters.placeholder_modal(),
-    )
-
-    global cache
-    cache = tidyhq.fresh_cache(cache=cache, config=config)
-
     # Get options from body
     categories = []
     states = body["view"]["state"]["values"]
@@ -138,48 +284,50 @@ def filter_authed_tools_modal(ack, body, client):
                 for option in states[state][field]["selected_options"]:
                     categories.append(option["value"])
 
-    modal = formatters.authed_machines_modal(
-        user=body["user"]["id"],
-        config=config,
-        client=client,
-        cache=cache,
-        categories=categories,
-        machine_list=machine_list,
-    )
-    app.client.views_update(
-        view_id=v["view"]["id"],  # type: ignore
-        view=modal,
+    def render():
+        global cache
+        cache = tidyhq.fresh_cache(cache=cache, config=config)
+
+        return formatters.authed_machines_modal(
+            user=body["user"]["id"],
+            config=config,
+            client=client,
+            cache=cache,
+            categories=categories,
+            machine_list=machine_list,
+        )
+
+    open_rendered_modal(
+        trigger_id=body["trigger_id"],
+        render=render,
+        handler="filter_authed_tools_modal",
     )
 
 
 # Trainer buttons
 @app.action("trainer-select")
+@metrics.handler
 def select_user(ack, body, client):
     ack()
 
-    # Send a placeholder modal while we gather data
-    v = app.client.views_open(
-        trigger_id=body["trigger_id"],
-        view=formatters.placeholder_modal(),
-    )
-
-    global cache
-    cache = tidyhq.fresh_cache(cache=cache, config=config)
+    def render():
+        global cache
+        cache = tidyhq.fresh_cache(cache=cache, config=config)
 
-    modal = formatters.select_users_modal(
-        user=body["user"]["id"],
-        config=config,
-        client=client,
-        cache=cache,
-    )
+        return formatters.select_users_modal(
+            user=body["user"]["id"],
+            config=config,
+            client=client,
+            cache=cache,
+        )
 
-    app.client.views_update(
-        view_id=v["view"]["id"],  # type: ignore
-        view=modal,
+    open_rendered_modal(
+        trigger_id=body["trigger_id"], render=render, handler="select_user"
     )
 
 
 @app.action("trainer-add_training")
+@metrics.handler
 def add_training(ack, body, client):
     ack()
 
@@ -192,30 +340,29 @@ def add_training(ack, body, client):
         # No user has been selected, don't do anything
         return
 
-    # Send a placeholder modal while we gather data
-    v = app.client.views_push(
-        trigger_id=body["trigger_id"],
-        view=formatters.placeholder_modal(),
-    )
-
-    modal = formatters.trainer_change_authed_machines_modal(
-        user=user,
-        config=config,
-        client=client,
-        cache=cache,
-        machine_list=machine_list,
-        action="add",
-    )
+    def render():
+        modal = formatters.trainer_change_authed_machines_modal(
+            user=user,
+            config=config,
+            client=client,
+            cache=cache,
+            machine_list=machine_list,
+            action="add",
+        )
 
-    modal["private_metadata"] = f"add-{user}"
+        modal["private_metadata"] = f"add-{user}"
+        return modal
 
-    app.client.views_update(
-        view_id=v["view"]["id"],  # type: ignore
-        view=modal,
+    open_rendered_modal(
+        trigger_id=body["trigger_id"],
+        render=render,
+        handler="add_training",
+        push=True,
     )
 
 
 @app.action("trainer-remove_training")
+@metrics.handler
 def remove_training(ack, body, client):
     ack()
 
@@ -228,33 +375,36 @@ def remove_training(ack, body, client):
         # No user has been selected, don't do anything
         return
 
-    # Send a placeholder modal while we gather data
-    v = app.client.views_push(
-        trigger_id=body["trigger_id"],
-        view=formatters.placeholder_modal(),
-    )
-
-    modal = formatters.trainer_change_authed_machines_modal(
-        user=user,
-        config=config,
-        client=client,
-        cache=cache,
-        machine_list=machine_list,
-        action="remove",
-    )
+    def render():
+        modal = formatters.trainer_change_authed_machines_modal(
+            user=user,
+            config=config,
+            client=client,
+            cache=cache,
+            machine_list=machine_list,
+            action="remove",
+        )
 
-    modal["private_metadata"] = f"remove-{user}"
+        modal["private_metadata"] = f"remove-{user}"
+        return modal
 
-    app.client.views_update(
-        view_id=v["view"]["id"],  # type: ignore
-        view=modal,
+    open_rendered_modal(
+        trigger_id=body["trigger_id"],
+        render=render,
+        handler="remove_training",
+        push=True,
     )
 
 
 @app.view("trainer_authed_tools_modal_write")
+@metrics.handler
 def write_training_changes(ack, body, event):
     ack()
+    # Writing to TidyHQ and notifying Slack takes a while, don't hold up the listener
+    workers.submit("write_training_changes", apply_training_changes, body)
 
+
+def apply_training_changes(body):
     # Check if log file exists and create it if not
     try:
         with open("tidyhq_changes.log", "r") as f:
@@ -291,30 +441,44 @@ def write_training_changes(ack, body, event):
         # Check for a slack user ID
         slack_id = tidyhq.get_slack_id(config=config, contact=user_contact, cache=cache)
         if slack_id:
-            user_name += f" (<@{slack_id}>)"
+            user_name += f" ({user_contact.get('slack_mention') or f'<@{slack_id}>'})"
     else:
         user_name = "UNKNOWN"
 
     children = []
     exclusive = []
 
+    # Successful changes to apply to the cache once we're done
+    membership_changes = []
+
+    # In batch mode notifications are sent as one message per action once we're done
+    batch = config["slack"].get("batch_notifications", False)
+    batched: dict[str, list[dict]] = {"add": [], "remove": []}
+
+    def notify(change_action, machine_info):
+        if batch:
+            batched[change_action].append(machine_info)
+            return
+        slackUtils.notify_training(
+            action=change_action,
+            trainee=user,
+            trainee_formatted=user_name,
+            trainee_slack_id=slack_id,
+            machine_info=machine_info,
+            config=config,
+            trainer=body["user"]["id"],
+            app=app,
+        )
+
     for machine in machines:
         success = tidyhq.update_group_membership(
             tidyhq_id=user, group_id=machine, action=action, config=config
         )
         if success:
+            membership_changes.append((machine, action))
             machine_info = tidyhq.get_group_info(id=machine, cache=cache, config=config)
 
-            slackUtils.notify_training(
-                action=action,
-                trainee=user,
-                trainee_formatted=user_name,
-                trainee_slack_id=slack_id,
-                machine_info=machine_info,
-                config=config,
-                trainer=body["user"]["id"],
-                app=app,
-            )
+            notify(change_action=action, machine_info=machine_info)
 
             if machine_info.get("children", False):
                 children += machine_info["children"].split(",")
@@ -330,18 +494,10 @@ def write_training_changes(ack, body, event):
             tidyhq_id=user, group_id=machine, action=action, config=config
         )
         if success:
+            membership_changes.append((machine, action))
             machine_info = tidyhq.get_group_info(id=machine, cache=cache, config=config)
 
-            slackUtils.notify_training(
-                action=action,
-                trainee=user,
-                trainee_formatted=user_name,
-                trainee_slack_id=slack_id,
-                machine_info=machine_info,
-                config=config,
-                trainer=body["user"]["id"],
-                app=app,
-            )
+            notify(change_action=action, machine_info=machine_info)
         else:
             logging.error(f"Failed to {action} {user} for {machine}")
 
@@ -353,23 +509,27 @@ def write_training_changes(ack, body, event):
                 tidyhq_id=user, group_id=machine, action="remove", config=config
             )
             if success:
+                membership_changes.append((machine, "remove"))
                 machine_info = tidyhq.get_group_info(
                     id=machine, cache=cache, config=config
                 )
 
-                slackUtils.notify_training(
-                    action="remove",
-                    trainee=user,
-                    trainee_formatted=user_name,
-                    trainee_slack_id=slack_id,
-                    machine_info=machine_info,
-                    config=config,
-                    trainer=body["user"]["id"],
-                    app=app,
-                )
+                notify(change_action="remove", machine_info=machine_info)
             else:
                 logging.error(f"Failed to remove {user} for {machine}")
 
+    for change_action in batched:
+        slackUtils.notify_training_batch(
+            action=change_action,
+            trainee=user,
+            trainee_formatted=user_name,
+            trainee_slack_id=slack_id,
+            machines=batched[change_action],
+            config=config,
+            trainer=body["user"]["id"],
+            app=app,
+        )
+
     # Get the time debt if provided
     hours = (
         body["view"]["state"]["values"]
@@ -387,6 +547,7 @@ def write_training_changes(ack, body, event):
         # Send a message to the token channel
         slackUtils.send(
             app=app,
+            queue=True,
             channel=config["slack"]["token_channel"],
             message=f"Time debt of {hours}h hours recorded by <@{body['user']['id']}> for training {user_name}",
             metadata={
@@ -400,8 +561,10 @@ def write_training_changes(ack, body, event):
             },
         )
 
-    # Once all the changes have been made refresh the cache
-    cache = tidyhq.fresh_cache(config=config, force=True)
+    # Once all the changes have been made apply them to the cache, this also republishes the trainee's home
+    cache = tidyhq.patch_memberships(
+        cache=cache, contact_id=user, changes=membership_changes, config=config
+    )
 
 
 # Silence notifications of individual checkboxes
@@ -409,75 +572,61 @@ checkbox_pattern = re.compile(r"trainer-(add|remove)_training_write-\d*")
 
 
 @app.action({"action_id": checkbox_pattern})
+@metrics.handler
 def ignore_individual_checkbox(ack, body, logger):
     ack()
 
 
 @app.view("filter_trainer_select_modal")
+@metrics.handler
 def check_user_training(ack, body, client):
     ack()
 
-    # Send a placeholder modal while we gather data
-    v = app.client.views_open(
-        trigger_id=body["trigger_id"],
-        view=formatters.placeholder_modal(),
-    )
-
     # Get selected user
     user = list(body["view"]["state"]["values"].values())[0]["select_user"][
         "selected_option"
     ]["value"]
 
-    modal = formatters.trainer_check_authed_machines_modal(
-        user=user,
-        config=config,
-        client=client,
-        cache=cache,
-        machine_list=machine_list,
-    )
+    def render():
+        return formatters.trainer_check_authed_machines_modal(
+            user=user,
+            config=config,
+            client=client,
+            cache=cache,
+            machine_list=machine_list,
+        )
 
-    app.client.views_update(
-        view_id=v["view"]["id"],  # type: ignore
-        view=modal,
+    open_rendered_modal(
+        trigger_id=body["trigger_id"], render=render, handler="check_user_training"
     )
 
 
 @app.action("trainer-check_tool_training")
+@metrics.handler
 def check_tool_training(ack, body, client):
     ack()
 
-    # Send a placeholder modal while we gather data
-    v = app.client.views_open(
-        trigger_id=body["trigger_id"],
-        view=formatters.placeholder_modal(),
-    )
+    def render():
+        global cache
+        cache = tidyhq.fresh_cache(cache=cache, config=config)
 
-    global cache
-    cache = tidyhq.fresh_cache(cache=cache, config=config)
-
-    modal = formatters.tool_selector_modal(
-        config=config,
-        client=client,
-        cache=cache,
-        machine_list=machine_list,
-    )
+        return formatters.tool_selector_modal(
+            config=config,
+            client=client,
+            cache=cache,
+            machine_list=machine_list,
+        )
 
-    app.client.views_update(
-        view_id=v["view"]["id"],  # type: ignore
-        view=modal,
+    open_rendered_modal(
+        trigger_id=body["trigger_id"], render=render, handler="check_tool_training"
     )
 
 
 @app.view("tool_selector_modal")
+@metrics.handler
 def handle_view_submission_events(ack, body, client):
     ack()
 
-    # Send a placeholder modal while we gather data
-    v = app.client.views_open(
-        trigger_id=body["trigger_id"],
-        view=formatters.placeholder_modal(),
-    )
-
     # Get selected option
     choice = list(body["view"]["state"]["values"].values())[0]["tool_selector"][
         "selected_option"
@@ -485,21 +634,25 @@ def handle_view_submission_events(ack, body, client):
     # We added the category to this value earlier to create a unique value but we don't need it now
     machine = choice.split("-")[0]
 
-    modal = formatters.machine_report_modal(
-        config=config, cache=cache, machine_list=machine_list, machine=machine
-    )
-    app.client.views_update(
-        view_id=v["view"]["id"],  # type: ignore
-        view=modal,
+    def render():
+        return formatters.machine_report_modal(
+            config=config, cache=cache, machine_list=machine_list, machine=machine
+        )
+
+    open_rendered_modal(
+        trigger_id=body["trigger_id"], render=render, handler="tool_selector_modal"
     )
 
 
 @app.action("trainer-refresh")
+@metrics.handler
 def refresh_tidyhq(ack, body, client):
     ack()
 
     # Send a placeholder message while we refresh data
-    v = app.client.views_open(
+    v = ratelimit.call(
+        app.client,
+        "views.open",
         trigger_id=body["trigger_id"],
         view=formatters.placeholder_modal(
             text="Refreshing TidyHQ data. This may take a moment but you can close this window if you like."
@@ -509,66 +662,81 @@ def refresh_tidyhq(ack, body, client):
     # Start counting time
     start_time = time.time()
 
-    logging.info(f"User {body['user']['id']} refreshed data from TidyHQ")
-    global cache
-    cache = tidyhq.fresh_cache(config=config, force=True)
-    # Refresh the user's home
-    slackUtils.updateHome(
-        user=body["user"]["id"],
-        client=client,
-        config=config,
-        cache=cache,
-        machine_raw=machine_list,
-    )
-
-    # Let the user know the update was successful
-    elapsed_time = time.time() - start_time
-    app.client.views_update(
-        view_id=v["view"]["id"],  # type: ignore
-        view=formatters.placeholder_modal(
-            text=strings.tidyhq_update_complete.format(elapsed_time)
-        ),
-    )
+    def refresh():
+        logging.info(f"User {body['user']['id']} refreshed data from TidyHQ")
+        global cache
+        cache = tidyhq.fresh_cache(cache=cache, config=config, force=True)
+        # Refresh the user's home
+        slackUtils.updateHome(
+            user=body["user"]["id"],
+            client=client,
+            config=config,
+            cache=cache,
+            machine_raw=machine_list,
+        )
 
+        # Let the user know the update was successful
+        elapsed_time = time.time() - start_time
+        ratelimit.call(
+            app.client,
+            "views.update",
+            view_id=v["view"]["id"],  # type: ignore
+            view=formatters.placeholder_modal(
+                text=strings.tidyhq_update_complete.format(elapsed_time)
+            ),
+        )
 
-# Respond with users
-@app.options("select_user")
-def send_user_options(ack, body):
-    search_query = body["value"]
-    users = tidyhq.list_all(config=config, cache=cache, filters=[])
-    options_existing = []
-    options_new = []
-    raw_options = []
+    workers.submit("refresh_tidyhq", refresh)
 
-    # We can't send more than 100 options total
-    total_options = 0
 
-    for tidy_user in users:
-        if len(raw_options) > 100:
-            break
+# Turn profiling on or off for handlers and tasks by name
+@app.command(config["slack"].get("profile_command", "/profile"))
+@metrics.handler
+def profile_command(ack, body, respond):
+    ack()
+    if not slackUtils.check_trainer(user=body["user_id"], config=config, app=app):
+        respond(strings.profile_trainers_only)
+        return
 
-        # Find the name
-        contact = tidyhq.get_contact(contact_id=tidy_user, cache=cache)
-        if not contact:
-            break
+    words = body.get("text", "").split()
+    if words[:1] == ["off"]:
+        profiling.disable(names=words[1:] or None)
+    elif words:
+        profiling.enable(names=words)
+    logger.info(f"User {body['user_id']} ran profile command: {body.get('text')}")
+
+    current = profiling.targets()
+    if current:
+        respond(
+            strings.profile_status.format(
+                ", ".join(f"`{name}`" for name in sorted(current)),
+                profiling.profile_dir,
+            )
+        )
+    else:
+        respond(strings.profile_off)
 
-        name = tidyhq.format_contact(contact=contact)
 
-        if search_query.lower() in str(name).lower():
-            # Check if the user has been trained on at least one machine
+# Respond with users
+@app.options("select_user")
+@metrics.handler
+def send_user_options(ack, body):
+    # We can't send more than 100 options total
+    results = search.query(cache=cache, config=config, text=body["value"], limit=100)
 
-            # Create an item
-            option = formatters.create_option(
-                text=f"{name}", value=f"{tidy_user}", capitalisation=False
-            )
+    options_existing = []
+    options_new = []
+    for result in results:
+        # Create an item
+        option = formatters.create_option(
+            text=result["name"], value=f"{result['id']}", capitalisation=False
+        )
 
-            # Add the item to the correct group
-            if total_options < 100:
-                total_options += 1
-                if tidyhq.find_groups_for_user(contact=contact, config=config):
-                    options_existing.append(option)
-                else:
-                    options_new.append(option)
+        # Add the item to the correct group depending on whether the user has been trained on at least one machine
+        if result["existing"]:
+            options_existing.append(option)
+        else:
+            options_new.append(option)
 
     # Set up option groups
 
@@ -591,6 +759,7 @@ def send_user_options(ack, body):
 
 
 @app.action("checkin-contact")
+@metrics.handler
 def checkin_contact(ack, body, logger):
     ack()
 
@@ -607,20 +776,11 @@ def checkin_contact(ack, body, logger):
     # Get machine name
     machine_info = tidyhq.get_group_info(id=machine_id, cache=cache, config=config)
 
-    # Open a conversation with the operator and trainer
-    response: SlackResponse = app.client.conversations_open(
-        users=f"{operator_id},{trainer_id}"
-    )  # type: ignore
-    if not response:
-        logger.error(f"Failed to open conversation with {operator_id} and {trainer_id}")
-        return
-
-    channel_id = response.get("channel", {}).get("id")
-
-    # Send an explainer message to the operator
+    # Send an explainer message to the operator in a conversation with the operator and trainer
     slackUtils.send(
         app=app,
-        channel=channel_id,
+        queue=True,
+        slack_id=f"{operator_id},{trainer_id}",
         message=strings.checkin_explainer_operator.format(
             machine_info["name"], int(sign_off_days_ago)
         ),
@@ -629,6 +789,7 @@ def checkin_contact(ack, body, logger):
     # Send a message to the trainer channel letting other trainers know someone is following up
     slackUtils.send(
         app=app,
+        queue=True,
         channel=config["slack"]["notification_channel"],
         message=f"<@{body['user']['id']}> triggered a conversation regarding this induction",
         thread_ts=body["container"]["thread_ts"],
@@ -636,6 +797,7 @@ def checkin_contact(ack, body, logger):
 
 
 @app.action("checkin-approve")
+@metrics.handler
 def checkin_approve(ack, body, logger):
     ack()
     # Get information from the button
@@ -651,22 +813,18 @@ def checkin_approve(ack, body, logger):
     # Get machine name
     machine_info = tidyhq.get_group_info(id=machine_id, cache=cache, config=config)
 
-    # Open a conversation with the operator and trainer
-    response: SlackResponse = app.client.conversations_open(
-        users=f"{operator_id},{trainer_id}"
-    )  # type: ignore
-
-    channel_id = response.get("channel", {}).get("id")
-
-    # Send an explainer message to the operator
+    # Send an explainer message to the operator in a conversation with the operator and trainer
     slackUtils.send(
         app=app,
-        channel=channel_id,
+        queue=True,
+        slack_id=f"{operator_id},{trainer_id}",
         message=strings.checkin_induction_approved.format(machine_info["name"]),
     )
 
     # Update the original message
-    app.client.chat_update(
+    ratelimit.call(
+        app.client,
+        "chat.update",
         channel=config["slack"]["notification_channel"],
         ts=body["container"]["message_ts"],
         text=strings.check_in_explainer_finished.format(
@@ -677,16 +835,38 @@ def checkin_approve(ack, body, logger):
     # Send notification that the induction has been approved
     slackUtils.send(
         app=app,
+        queue=True,
         channel=config["slack"]["notification_channel"],
         thread_ts=body["container"]["message_ts"],
         message=f"This induction was confirmed by <@{body['user']['id']}>",
+        # checkin.py uses this to tell which machine in a sign off was checked in
+        metadata={
+            "event_type": "training_check_in",
+            "event_payload": {
+                "machine": int(machine_id),
+                "operator": operator_id,
+                "action": "confirmed",
+            },
+        },
     )
 
+    # No need to remind the trainer any more
+    if ledger_path:
+        followups.resolve(
+            path=ledger_path,
+            operator_ref=operator_id,
+            machine=machine_id,
+        )
+
 
 @app.action("checkin-remove")
+@metrics.handler
 def checkin_remove(ack, body, logger):
     ack()
+    workers.submit("checkin_remove", remove_checked_in_training, body)
+
 
+def remove_checked_in_training(body):
     # We're going to be updating the cache later on
     global cache
 
@@ -737,6 +917,7 @@ def checkin_remove(ack, body, logger):
 
         slackUtils.send(
             app=app,
+            queue=True,
             channel=config["slack"]["notification_channel"],
             message=message,
         )
@@ -747,22 +928,18 @@ def checkin_remove(ack, body, logger):
                 f"{time.time()},{body['user']['id']},{action},{contact_id},{machine_id}\n"
             )
 
-        # Open a conversation with the operator and trainer
-        response: SlackResponse = app.client.conversations_open(
-            users=f"{operator_id},{trainer_id}"
-        )  # type: ignore
-
-        channel_id = response.get("channel", {}).get("id")
-
-        # Send an explainer message to the operator
+        # Send an explainer message to the operator in a conversation with the operator and trainer
         slackUtils.send(
             app=app,
-            channel=channel_id,
+            queue=True,
+            slack_id=f"{operator_id},{trainer_id}",
             message=strings.checkin_induction_rejected.format(machine_info["name"]),
         )
 
         # Update the original message
-        app.client.chat_update(
+        ratelimit.call(
+            app.client,
+            "chat.update",
             channel=config["slack"]["notification_channel"],
             ts=body["container"]["message_ts"],
             text=strings.check_in_explainer_finished.format(
@@ -772,45 +949,50 @@ def checkin_remove(ack, body, logger):
 
         slackUtils.send(
             app=app,
+            queue=True,
             channel=config["slack"]["notification_channel"],
             thread_ts=body["container"]["thread_ts"],
             message=f"This induction was removed by <@{body['user']['id']}>",
+            metadata={
+                "event_type": "training_check_in",
+                "event_payload": {
+                    "machine": int(machine_id),
+                    "operator": operator_id,
+                    "action": "removed",
+                },
+            },
         )
 
-        # Refresh the cache to reflect the change
-        cache = tidyhq.fresh_cache(config=config, force=True)
-
-
-# Get all linked users from TidyHQ
-
-logger.info("Getting TidyHQ data from cache")
-
-cache = tidyhq.fresh_cache(config=config)
-logger.debug(
-    f"Loaded {len(cache['contacts'])} contacts and {len(cache['groups'])} groups"
-)
+        if ledger_path:
+            followups.resolve(
+                path=ledger_path,
+                operator_ref=operator_id,
+                machine=machine_id,
+            )
 
-# Construct machine list
-logger.info("Constructing machine list")
-machine_list = machines.build_from_tidyhq(cache=cache, config=config)
+        # Apply the change to the cache, this also republishes the operator's home
+        cache = tidyhq.patch_memberships(
+            cache=cache,
+            contact_id=contact_id,
+            changes=[(machine_id, action)],
+            config=config,
+        )
 
-# Get our user ID
-info = app.client.auth_test()
-logger.debug(f"Connected as @{info['user']} to {info['team']}")
 
+# Home republishing
 
-# Check whether we're running as a cron job
-if "-c" in sys.argv:
-    # Update homes for all slack users
-    logger.info("Updating homes for all users")
 
-    # Get a list of all users from slack
-    slack_response = app.client.users_list()
+def list_slack_users() -> list[str]:
+    """Get the IDs of all human Slack users in the workspace."""
+    slack_response = ratelimit.call(app.client, "users.list", priority="background")
     slack_users = []
     while slack_response.data.get("response_metadata", {}).get("next_cursor"):  # type: ignore
         slack_users += slack_response.data["members"]  # type: ignore
-        slack_response = app.client.users_list(
-            cursor=slack_response.data["response_metadata"]["next_cursor"]  # type: ignore
+        slack_response = ratelimit.call(
+            app.client,
+            "users.list",
+            priority="background",
+            cursor=slack_response.data["response_metadata"]["next_cursor"],  # type: ignore
         )
     slack_users += slack_response.data["members"]  # type: ignore
 
@@ -818,28 +1000,335 @@ if "-c" in sys.argv:
 
     # Convert slack response to list of users since it comes as an odd iterable
     for user in slack_users:
-        # pprint(user)
         if user["is_bot"] or user["deleted"]:
             continue
         users.append(user["id"])
 
-    logger.info(f"Found {len(users)} users")
+    return users
 
-    x = 1
+
+def update_homes(
+    users: list[str], home_cache: dict, refresh_trainers: bool = False
+) -> tuple[int, int]:
+    """Publish the homes of a list of Slack users concurrently.
+
+    refresh_trainers fetches trainer membership from Slack first rather than using the cached copy, for fan-outs to everyone.
+    """
+
+    # Trainer membership won't change meaningfully during the fan-out so only look it up once
+    trainers = slackUtils.trainer_users(
+        client=app.client,
+        config=config,
+        force=refresh_trainers,
+        priority="background",
+    )
+
+    # Users without a linked TidyHQ contact or any sign offs all get the same generic home
+    slack_index = tidyhq.index(cache=home_cache, config=config)["slack"]
+    generic_users = []
+    linked_users = []
     for user in users:
+        if user in slack_index and machines.user(
+            id=user, cache=home_cache, config=config, machines=machine_list
+        ):
+            linked_users.append(user)
+        else:
+            generic_users.append(user)
+
+    logger.info(
+        f"{len(linked_users)} users have sign offs, {len(generic_users)} will get the generic home"
+    )
+
+    # Render the generic home once and publish the same blocks to everyone
+    generic_home = None
+    if generic_users:
+        generic_home = formatters.home(
+            user=generic_users[0],
+            config=config,
+            client=app.client,
+            cache=home_cache,
+            machine_raw=machine_list,
+            trainers=trainers,
+        )
+
+    linked_set = set(linked_users)
+
+    def publish_home(user):
         slackUtils.updateHome(
             user=user,
             client=app.client,
             config=config,
-            cache=cache,
+            cache=home_cache,
             machine_raw=machine_list,
+            home_blocks=None if user in linked_set else generic_home,
+            priority="background",
+            trainers=trainers,
+        )
+
+    # Publishing is rate limited per method so the pool mostly hides network latency
+    return fanout.run(
+        items=linked_users + generic_users,
+        work=publish_home,
+        workers=config.get("fanout_workers", 8),
+        label="homes",
+    )
+
+
+# Only one republish runs at a time so bursts of changes don't stack up fan-outs
+republish_lock = threading.Lock()
+
+
+def republish_changed_homes(changes: dict, new_cache: dict) -> None:
+    """Republish the homes affected by a cache refresh."""
+    global machine_list
+
+    # Get the search index ready before anyone starts typing
+    search.build(cache=new_cache, config=config)
+
+    with republish_lock:
+        if changes.get("remote"):
+            # Another process sharing the cache store made the change and has republished already
+            if changes["groups"]:
+                machine_list = machines.build_from_tidyhq(
+                    cache=new_cache, config=config
+                )
+            return
+
+        if changes["groups"]:
+            # Group metadata (levels, categories etc) is shown to everyone
+            logger.info(
+                f"{len(changes['groups'])} groups changed, republishing all homes"
+            )
+            machine_list = machines.build_from_tidyhq(cache=new_cache, config=config)
+            update_homes(
+                users=list_slack_users(), home_cache=new_cache, refresh_trainers=True
+            )
+            return
+
+        users = []
+        for contact_id in changes["contacts"]:
+            slack_id = tidyhq.get_slack_id(
+                config=config, id=contact_id, cache=new_cache
+            )
+            if slack_id:
+                users.append(slack_id)
+
+        if users:
+            logger.info(f"Sign offs changed for {len(users)} Slack users")
+            update_homes(users=users, home_cache=new_cache)
+
+
+def save_snapshot(snapshot_cache: dict) -> None:
+    if config.get("startup_snapshot", True):
+        snapshot.save(cache=snapshot_cache, config=config, machine_list=machine_list)
+
+
+def on_cache_change(changes: dict, new_cache: dict) -> None:
+    def republish():
+        try:
+            republish_changed_homes(changes=changes, new_cache=new_cache)
+        finally:
+            # Save after the machine list has caught up so the next start begins from here
+            save_snapshot(snapshot_cache=new_cache)
+
+    # Republish in the background so whatever triggered the refresh isn't held up
+    threading.Thread(target=republish, daemon=True).start()
+
+
+# Get all linked users from TidyHQ
+
+# A snapshot from the last run lets us connect straight away, it's brought up to date once we're connected
+# Cron runs need current data so always start fresh
+snapshot_loaded = None
+if config.get("startup_snapshot", True) and "-c" not in sys.argv:
+    snapshot_loaded = snapshot.load(config=config)
+
+if snapshot_loaded:
+    cache, machine_list = snapshot_loaded
+    startup_step("snapshot")
+else:
+    logger.info("Getting TidyHQ data from cache")
+
+    cache = tidyhq.fresh_cache(config=config)
+    logger.debug(
+        f"Loaded {len(cache['contacts'])} contacts and {len(cache['groups'])} groups"
+    )
+    startup_step("cache")
+
+    # Construct machine list
+    logger.info("Constructing machine list")
+    machine_list = machines.build_from_tidyhq(cache=cache, config=config)
+    startup_step("machine list")
+
+    # Build the user search index
+    search.build(cache=cache, config=config)
+    startup_step("search index")
+
+# Check whether we're running as a cron job
+if __name__ == "__main__" and "-c" in sys.argv:
+    # When several instances share a lease database only the first cron run in each period does the fan-out
+    if config.get("leader_lease") and not leader.claim(
+        path=config["leader_lease"],
+        name="home_fanout",
+        period=config.get("cron_claim_period", 3600),
+    ):
+        sys.exit(0)
+
+    # Update homes for all slack users
+    logger.info("Updating homes for all users")
+
+    users = list_slack_users()
+    logger.info(f"Found {len(users)} users")
+
+    done, failed = update_homes(users=users, home_cache=cache, refresh_trainers=True)
+    logger.info(f"All homes updated ({done})")
+    if failed and config.get("leader_lease"):
+        # Let another instance's cron have a go
+        leader.release(path=config["leader_lease"], name="home_fanout")
+    sys.exit(1 if failed else 0)
+
+# Keep homes current as the cache changes
+tidyhq.subscribe(on_cache_change)
+
+# Values read whenever metrics are exported
+metrics.gauge("tidyhq_cache_age_seconds", lambda: time.time() - cache["time"])
+metrics.gauge("outbox_queued", lambda: outbox.depth() if outbox.running() else None)
+metrics.gauge("worker_queued", lambda: workers.stats()["queued"])
+metrics.gauge("worker_running", lambda: workers.stats()["running"])
+
+
+def refresh_cache_as_leader() -> None:
+    """Keep the shared cache fresh from the leader so requests on other instances never wait on TidyHQ."""
+    global cache
+    interval = min(60, config["cache_expiry"] / 4)
+    while True:
+        time.sleep(interval)
+        if leader.is_leader():
+            try:
+                cache = tidyhq.fresh_cache(cache=cache, config=config)
+            except Exception:
+                logger.exception("Leader cache refresh failed")
+
+
+def revalidate_snapshot() -> None:
+    """Bring a cache loaded from the startup snapshot up to date, republishing anything that changed while we were down."""
+    global cache
+    start = time.time()
+    info = app.client.auth_test()
+    logger.debug(f"Connected as @{info['user']} to {info['team']}")
+
+    current = tidyhq.fresh_cache(config=config)
+    if tidyhq.generation(current) == tidyhq.generation(cache):
+        # Keep the snapshot's copy so the restored indexes stay in use
+        if "store_version" in current:
+            cache["store_version"] = current["store_version"]
+        logger.info(f"Startup snapshot is current ({time.time() - start:.2f}s)")
+        return
+
+    old_cache, cache = cache, current
+    logger.info(f"Startup snapshot was out of date ({time.time() - start:.2f}s)")
+    # Subscribers rebuild what changed and save a new snapshot
+    if not tidyhq.publish_changes(old=old_cache, new=current, config=config):
+        save_snapshot(snapshot_cache=current)
+
+
+def send_follow_up(sign_off: dict) -> None:
+    """Remind the trainer to follow up on a sign off that's due (see followups.py)."""
+    thread_ts = sign_off["thread_ts"]
+    if outbox.is_ref(thread_ts):
+        delivered, ts = outbox.resolve(thread_ts)
+        if delivered or not outbox.is_pending(thread_ts):
+            # Otherwise it was queued by another instance or has been forgotten
+            thread_ts = ts
+    if not thread_ts:
+        # Without the sign off notification the reminder would have no context
+        logger.warning(
+            f"Skipping follow up {sign_off['id']}, its sign off notification wasn't delivered"
+        )
+        return
+
+    days = round((time.time() - sign_off["signed_off"]) / 86400)
+    slackUtils.send(
+        app=app,
+        queue=True,
+        channel=sign_off["channel"],
+        thread_ts=thread_ts,
+        message=f"Hey <@{sign_off['trainer']}>, can you please follow up with {sign_off['operator_mention']} about their recent sign off for {sign_off['machine_name']}? It's been {days} days since the sign off.",
+        priority="background",
+    )
+
+
+def start_background(http: bool = False) -> None:
+    """Start the worker pool, outbox and metrics for a long running bot process."""
+    # Rendering and TidyHQ work happens on a separate pool so slow work can't starve the socket mode connection
+    workers.start(size=config.get("render_workers", 4))
+
+    if config.get("leader_lease"):
+        if not config.get("cache_store"):
+            logger.warning(
+                "leader_lease is set without cache_store, every instance will still refresh its own cache"
+            )
+        leader.start(
+            path=config["leader_lease"],
+            name="slack",
+            ttl=config.get("leader_ttl", 30),
         )
-        logger.debug(f"Updated home for {user} ({x}/{len(users)})")
-        x += 1
-    logger.info("All homes updated ({x})")
-    sys.exit(0)
+        threading.Thread(
+            target=refresh_cache_as_leader, name="leader-refresh", daemon=True
+        ).start()
+
+    if http:
+        # Each worker has its own rate limit buckets so they split Slack's limits between them
+        ratelimit.share_with(config.get("http_workers", 1))
+
+        # The outbox spool belongs to a single process so HTTP workers send notifications directly
+        logger.info("Running in HTTP mode, notifications won't be queued")
+    else:
+        # Deliver queued notifications, including any left over from before a restart
+        slackUtils.start_outbox(app=app)
+
+    if ledger_path:
+        # Send follow up reminders as they fall due, including any that were due while we were down
+        followups.start(path=ledger_path, send=send_follow_up)
+
+    if config.get("metrics_port"):
+        try:
+            metrics.serve(port=config["metrics_port"])
+        except OSError:
+            # In HTTP mode the first worker to start serves metrics
+            logger.warning(f"Metrics port {config['metrics_port']} is already in use")
+    metrics.log_summaries(interval=config.get("metrics_summary_interval", 300))
+
+    if config.get("tidyhq_webhook_port"):
+        try:
+            webhooks.serve(
+                port=config["tidyhq_webhook_port"],
+                host=config.get("tidyhq_webhook_host", "127.0.0.1"),
+                config=config,
+                get_cache=lambda: cache,
+            )
+        except OSError:
+            # In HTTP mode the first worker to start receives webhooks and the others pick up its changes from cache_store
+            logger.warning(
+                f"Webhook port {config['tidyhq_webhook_port']} is already in use"
+            )
+
+    if snapshot_loaded:
+        threading.Thread(
+            target=revalidate_snapshot, name="revalidate-snapshot", daemon=True
+        ).start()
+    else:
+        # Give the next start a snapshot to begin from
+        threading.Thread(
+            target=save_snapshot, args=(cache,), name="save-snapshot", daemon=True
+        ).start()
 
 
 if __name__ == "__main__":
+    start_background()
     handler = SocketModeHandler(app, config["slack"]["app_token"])
-    handler.start()
+    handler.connect()
+    startup_step("connect")
+    log_startup_timings()
+    # Block like handler.start() does, the connection runs on its own threads
+    threading.Event().wait()
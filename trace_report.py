@@ -0,0 +1,56 @@
+# Print the spans of a trace written by the Slack bot as a tree, to find critical paths and serial waits
+# Usage: trace_report.py [trace_id] (defaults to the most recent trace)
+
+import json
+import sys
+
+# Load config from file
+with open("config.json") as f:
+    config: dict = json.load(f)
+
+traces: dict[str, list[dict]] = {}
+with open(config.get("trace_file", "traces.jsonl")) as f:
+    for line in f:
+        try:
+            span = json.loads(line)
+        except json.decoder.JSONDecodeError:
+            continue
+        traces.setdefault(span["trace_id"], []).append(span)
+
+if not traces:
+    print("No traces recorded")
+    sys.exit(1)
+
+if len(sys.argv) > 1:
+    trace_id = sys.argv[1]
+    if trace_id not in traces:
+        print(f"Trace {trace_id} not found")
+        sys.exit(1)
+else:
+    # Spans are written as they finish so the most recent trace is the one that started last
+    trace_id = max(traces, key=lambda t: min(span["start"] for span in traces[t]))
+
+spans = traces[trace_id]
+children: dict[str | None, list[dict]] = {}
+for span in spans:
+    children.setdefault(span["parent_id"], []).append(span)
+
+trace_start = min(span["start"] for span in spans)
+trace_end = max(span["start"] + span["duration"] for span in spans)
+print(f"Trace {trace_id}: {len(spans)} spans over {trace_end - trace_start:.3f}s")
+
+
+def show(span: dict, depth: int) -> None:
+    attributes = ", ".join(f"{k}={v}" for k, v in span["attributes"].items())
+    print(
+        f"{span['start'] - trace_start:8.3f}s {span['duration']:8.3f}s  {'  ' * depth}{span['name']}"
+        + (f" ({attributes})" if attributes else "")
+        + (" ERROR" if span["status"] == "error" else "")
+        + f" [{span['thread']}]"
+    )
+    for child in sorted(children.get(span["span_id"], []), key=lambda s: s["start"]):
+        show(child, depth + 1)
+
+
+for root in sorted(children.get(None, []), key=lambda s: s["start"]):
+    show(root, 0)
@@ -0,0 +1,122 @@
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+# Set up logging
+logger = logging.getLogger("cachestore")
+
+# A TidyHQ cache shared between bot processes (eg HTTP mode workers) in a SQLite database
+# Every write bumps the version so each process can cheaply check whether its copy is current
+
+_local = threading.local()
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    """Get this thread's connection to the store, creating the table if needed."""
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    if path not in connections:
+        connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL, data TEXT NOT NULL)"
+        )
+        connections[path] = connection
+    return connections[path]
+
+
+def version(path: str) -> int:
+    """The version of the stored cache, 0 if nothing has been stored yet."""
+    row = _connect(path).execute("SELECT version FROM cache WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+
+def read(path: str) -> tuple[int, dict | None]:
+    """Return the stored cache and its version."""
+    row = (
+        _connect(path)
+        .execute("SELECT version, data FROM cache WHERE id = 1")
+        .fetchone()
+    )
+    if not row:
+        return 0, None
+    return row[0], json.loads(row[1])
+
+
+def write(path: str, cache: dict) -> int:
+    """Store a cache, returning its new version."""
+    data = json.dumps(cache)
+    connection = _connect(path)
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        new_version = connection.execute(
+            "SELECT COALESCE(MAX(version), 0) + 1 FROM cache"
+        ).fetchone()[0]
+        connection.execute(
+            "INSERT OR REPLACE INTO cache (id, version, data) VALUES (1, ?, ?)",
+            (new_version, data),
+        )
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    logger.debug(f"Stored cache version {new_version} ({len(data)} bytes)")
+    return new_version
+
+
+def update(
+    path: str, patch: Callable[[dict], Any], default: dict
+) -> tuple[int, dict, Any]:
+    """Apply patch to the newest stored cache and store the result in one transaction.
+
+    Patches from different processes are applied one after the other instead of overwriting each other.
+    default is patched instead if nothing has been stored yet. Returns the new version, the patched cache and what patch returned.
+    """
+    connection = _connect(path)
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        row = connection.execute(
+            "SELECT version, data FROM cache WHERE id = 1"
+        ).fetchone()
+        cache = json.loads(row[1]) if row else default
+        result = patch(cache)
+        new_version = (row[0] if row else 0) + 1
+        data = json.dumps(cache)
+        connection.execute(
+            "INSERT OR REPLACE INTO cache (id, version, data) VALUES (1, ?, ?)",
+            (new_version, data),
+        )
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    logger.debug(f"Stored patched cache version {new_version} ({len(data)} bytes)")
+    return new_version, cache, result
+
+
+@contextmanager
+def refresh_lock(path: str, wait: bool = False) -> Iterator[bool]:
+    """Make sure only one process refreshes the cache from TidyHQ at a time.
+
+    Yields whether the lock was acquired. Without wait it isn't acquired if another process is already refreshing.
+    """
+    with open(f"{path}.lock", "w") as lock_file:
+        try:
+            fcntl.flock(
+                lock_file, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB
+            )
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            lock_file.write(str(os.getpid()))
+            lock_file.flush()
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
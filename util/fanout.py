@@ -0,0 +1,53 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable
+
+# Set up logging
+logger = logging.getLogger("fanout")
+
+
+def run(
+    items: list,
+    work: Callable[[Any], Any],
+    workers: int = 8,
+    label: str = "items",
+    progress_interval: float = 10,
+) -> tuple[int, int]:
+    """Run work(item) for every item on a bounded pool of worker threads.
+
+    Rate limiting is left to the work itself (see ratelimit.call). Progress and throughput are logged every progress_interval seconds.
+
+    Returns the number of items that succeeded and failed.
+    """
+    if not items:
+        return 0, 0
+
+    start = time.time()
+    last_progress = start
+    done = 0
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(work, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                done += 1
+            except Exception:
+                failed += 1
+                logger.exception(f"Failed to process {futures[future]}")
+
+            now = time.time()
+            if now - last_progress >= progress_interval:
+                last_progress = now
+                logger.info(
+                    f"Processed {done + failed}/{len(items)} {label} ({(done + failed) / (now - start):.1f}/s)"
+                )
+
+    elapsed = time.time() - start
+    logger.info(
+        f"Processed {len(items)} {label} in {elapsed:.1f}s ({len(items) / max(elapsed, 0.001):.1f}/s), {failed} failed"
+    )
+
+    return done, failed
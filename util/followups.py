@@ -0,0 +1,160 @@
+import heapq
+import logging
+import sqlite3
+import threading
+import time
+from typing import Callable
+
+from . import ledger, outbox
+
+# Set up logging
+logger = logging.getLogger("followups")
+
+# Sends each follow up reminder once when it's due, from a priority queue of ledger entries ordered by due time
+# Anything that fell due while the bot was down is sent as soon as the scheduler starts
+
+# How often to pick up sign offs recorded by other instances sharing the ledger, and sign offs whose send failed
+reload_interval = 3600
+
+# How long to wait before trying a failed reminder again
+retry_delay = 300
+
+# How long an instance has to send a reminder it's claimed before it's sent by someone else
+# A reminder that was sent just before its sender died may be sent twice, but one is never lost
+send_lease = 600
+
+_path: str | None = None
+_send: Callable[[dict], None] | None = None
+_queue: list[tuple[float, int, dict]] = []
+_queued: set[int] = set()
+_lock = threading.Condition()
+
+
+def add(path: str, **sign_off) -> None:
+    """Record a sign off that needs a follow up at sign_off["due"] and schedule it if the scheduler is running here."""
+    try:
+        sign_off = ledger.record(path, **sign_off)
+    except sqlite3.Error:
+        logger.exception(
+            f"Could not record sign off for {sign_off.get('machine_name')}"
+        )
+        return
+    logger.debug(f"Recorded sign off {sign_off['id']} due {sign_off['due']:.0f}")
+    if outbox.is_ref(sign_off.get("thread_ts")):
+        _track_thread(path, sign_off["thread_ts"])
+    if _path == path:
+        _schedule(sign_off)
+
+
+def resolve(path: str, operator_ref: str, machine) -> None:
+    """Stop the reminder for an operator and machine, eg once a trainer has checked in with them."""
+    try:
+        resolved = ledger.resolve(path, operator_ref=operator_ref, machine=machine)
+    except sqlite3.Error:
+        logger.exception("Could not resolve sign off")
+        return
+    if resolved:
+        logger.info(f"Resolved {resolved} follow ups for {operator_ref} on {machine}")
+
+
+def _track_thread(path: str, ref: str) -> None:
+    """Record the real ts of the parent message once the outbox delivers it, outbox references mean nothing to other instances."""
+
+    def delivered(ts: str | None) -> None:
+        try:
+            ledger.set_thread(path, ref=ref, ts=ts)
+        except sqlite3.Error:
+            logger.exception(f"Could not record thread for {ref}")
+
+    outbox.when_delivered(ref, delivered)
+
+
+def _schedule(sign_off: dict) -> None:
+    with _lock:
+        if sign_off["id"] in _queued:
+            return
+        _queued.add(sign_off["id"])
+        heapq.heappush(_queue, (sign_off["due"], sign_off["id"], sign_off))
+        _lock.notify()
+
+
+def _reload() -> None:
+    try:
+        sign_offs = ledger.pending(_path, lease=send_lease)  # type: ignore
+    except sqlite3.Error:
+        logger.exception("Could not load pending follow ups")
+        return
+    for sign_off in sign_offs:
+        _schedule(sign_off)
+
+
+def _fire(sign_off: dict) -> None:
+    # Another instance, or a trainer using the check in buttons, may have got there first
+    if not ledger.claim(_path, sign_off["id"], lease=send_lease):  # type: ignore
+        return
+    try:
+        # Pick up the thread's ts if it's been delivered since the sign off was loaded
+        sign_off = ledger.get(_path, sign_off["id"]) or sign_off  # type: ignore
+        _send(sign_off)  # type: ignore
+    except Exception:
+        logger.exception(f"Could not send follow up {sign_off['id']}")
+        due = time.time() + retry_delay
+        try:
+            ledger.retry(_path, sign_off["id"], due=due)  # type: ignore
+        except sqlite3.Error:
+            # The claim runs out after send_lease and it's picked up again then
+            logger.exception(f"Could not put follow up {sign_off['id']} back")
+            return
+        _schedule({**sign_off, "due": due})
+        return
+    ledger.sent(_path, sign_off["id"])  # type: ignore
+    logger.info(
+        f"Sent follow up for {sign_off['machine_name']} sign off of {sign_off['operator_mention']}"
+    )
+
+
+def _run() -> None:
+    next_reload = time.time() + reload_interval
+    while True:
+        now = time.time()
+        if now >= next_reload:
+            next_reload = now + reload_interval
+            _reload()
+
+        with _lock:
+            if not _queue or _queue[0][0] > now:
+                # Sleep until the next reminder is due, something new is scheduled or it's time to reload
+                wait = next_reload - now
+                if _queue:
+                    wait = min(wait, _queue[0][0] - now)
+                _lock.wait(timeout=max(0.1, wait))
+                continue
+            _, sign_off_id, sign_off = heapq.heappop(_queue)
+            _queued.discard(sign_off_id)
+
+        try:
+            _fire(sign_off)
+        except sqlite3.Error:
+            logger.exception(f"Could not claim follow up {sign_off_id}")
+
+
+def start(path: str, send: Callable[[dict], None]) -> None:
+    """Send follow up reminders from the ledger at path with send(sign_off) as they fall due."""
+    global _path, _send
+    _path, _send = path, send
+    _reload()
+    if outbox.running():
+        # Parent messages still in the outbox from before a restart
+        with _lock:
+            refs = {
+                sign_off["thread_ts"]
+                for _, _, sign_off in _queue
+                if outbox.is_ref(sign_off["thread_ts"])
+            }
+        for ref in refs:
+            _track_thread(path, ref)
+    overdue = sum(1 for due, _, _ in _queue if due <= time.time())
+    logger.info(
+        f"Scheduled {len(_queue)} follow ups from the ledger, {overdue} are overdue"
+    )
+    threading.Thread(target=_run, name="followups", daemon=True).start()
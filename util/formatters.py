@@ -2,12 +2,9 @@ import logging
 import os
 from copy import deepcopy as copy
 from datetime import datetime, timedelta
-from pprint import pprint
 from typing import Any, Literal
 import json
 
-import requests
-
 from . import blocks, misc, slackUtils, machines, tidyhq
 from editable_resources import strings
 
@@ -16,7 +13,7 @@ from editable_resources import strings
 logger = logging.getLogger("formatters")
 
 
-def home(user, config, client, cache, machine_raw):
+def home(user, config, client, cache, machine_raw, trainers=None):
     complete_section_emoji_map = {
         "3d": ":3d-printer:",
         "air": ":dash:",
@@ -64,35 +61,28 @@ def home(user, config, client, cache, machine_raw):
     button_actions = copy(blocks.actions)
     button_actions["block_id"] = "check_training"
 
-    # Get tool categories
-    tool_categories = machines.all(cache=cache, config=config, machines=machine_raw)
+    # Get precomputed tool categories
+    tool_summary = machines.summary(cache=cache, config=config, machines=machine_raw)
+
+    # Flattened list of the user's sign offs, excluding excluded machines
+    authed_machines_flat = set()
 
-    for category in tool_categories:
-        # Calculate total while accounting for excluded machines and probationary sign offs
-        total = 0
-        for machine in tool_categories[category]:
-            if machine not in machine_raw.get("exclude", []):
-                if (
-                    machine.get("level", "⚪") == "🅿️"
-                    and machine not in authed_machines[category]
-                ):
-                    continue
+    for category in tool_summary["categories"]:
+        authed = (
+            set(authed_machines.get(category, [])) & tool_summary["machines"][category]
+        )
+        authed_machines_flat |= authed
 
-                total += 1
+        # Total accounts for excluded machines and probationary sign offs
+        total = machines.user_total(
+            machine_summary=tool_summary, category=category, authed=authed
+        )
 
         # Create button text
-        if authed_machines:
-            if category in authed_machines:
-                button_text = f"{category.capitalize()} ({len(authed_machines[category])}/{total})"
-                if len(authed_machines[category]) == total:
-                    button_text += (
-                        f" {complete_section_emoji_map.get(category.lower(), ':star:')}"
-                    )
-            else:
-                button_text = f"{category.capitalize()} (0/{total})"
-        else:
-            button_text = (
-                f"{category.capitalize()} (0/{len(tool_categories[category])})"
+        button_text = f"{category.capitalize()} ({len(authed)}/{total})"
+        if authed and len(authed) == total:
+            button_text += (
+                f" {complete_section_emoji_map.get(category.lower(), ':star:')}"
             )
 
         button_actions = slackUtils.inject_button(
@@ -103,54 +93,16 @@ def home(user, config, client, cache, machine_raw):
         )
 
     # Calculate button text for category that includes all tools
-
-    # Create deduplicated list of all machines in all categories with list comprehension and excluding excluded machines
-    all_machines = []
-
-    # Generate flattened list of all machines
-    all_machines_flat = list(
-        set(
-            [
-                machine["id"]
-                for category in tool_categories
-                if category != "exclude"
-                for machine in tool_categories[category]
-                if machine not in machine_raw.get("exclude", [])
-            ]
-        )
+    all_total = machines.user_total(
+        machine_summary=tool_summary, category=None, authed=authed_machines_flat
     )
 
-    # Count all authed machines
-    if not authed_machines:
-        authed_machines_flat = []
-    else:
-        authed_machines_flat = list(
-            set(
-                [
-                    machine
-                    for category in authed_machines
-                    for machine in authed_machines[category]
-                    if machine not in machine_raw.get("exclude", [])
-                ]
-            )
-        )
-
-    # Remove probationary sign offs from all machines if they're not present in auth'd machines
-    for machine in all_machines_flat:
-        machine_info = tidyhq.get_group_info(id=machine, cache=cache, config=config)
-
-        if (
-            machine_info.get("level", "⚪") == "🅿️"
-            and machine not in authed_machines_flat
-        ):
-            all_machines_flat.remove(machine)
-
     if authed_machines:
-        button_text = f"All ({len(authed_machines_flat)}/{len(all_machines_flat)})"
-        if len(authed_machines_flat) >= len(all_machines_flat):
+        button_text = f"All ({len(authed_machines_flat)}/{all_total})"
+        if len(authed_machines_flat) >= all_total:
             button_text += " :partyparrot:"
     else:
-        button_text = f"All (0/{len(all_machines_flat)})"
+        button_text = f"All (0/{all_total})"
 
     category = "all"
     button_actions = slackUtils.inject_button(
@@ -179,8 +131,12 @@ def home(user, config, client, cache, machine_raw):
 
     # Skip checking trainer status for users with no sign offs since they can't be trainers and usergroups.list is rate limited
     if authed_machines:
-        # Check if the user is a trainer
-        if slackUtils.is_trainer(user=user, client=client, config=config):
+        # Check if the user is a trainer, fan-outs pass in the trainers they've already fetched
+        if (
+            user in trainers
+            if trainers is not None
+            else slackUtils.is_trainer(user=user, client=client, config=config)
+        ):
             trainer_blocks = []
 
             # Add trainer explainer
@@ -235,7 +191,8 @@ def authed_machines_modal(
     user: str, config: dict, client, cache: dict, categories: list, machine_list: dict
 ):
     # Generate list of machines
-    all_machines = machines.all(cache=cache, config=config, machines=machine_list)
+    tool_summary = machines.summary(cache=cache, config=config, machines=machine_list)
+    all_machines = tool_summary["categories"]
     authed_machines = machines.user(
         id=user, cache=cache, config=config, machines=machine_list
     )
@@ -535,7 +492,8 @@ def trainer_check_authed_machines_modal(
     user: str, config: dict, client, cache: dict, machine_list: dict
 ):
     # Generate list of machines
-    all_machines = machines.all(cache=cache, config=config, machines=machine_list)
+    tool_summary = machines.summary(cache=cache, config=config, machines=machine_list)
+    all_machines = tool_summary["categories"]
     authed_machines = machines.user(
         id=user, cache=cache, config=config, machines=machine_list
     )
@@ -624,7 +582,8 @@ def trainer_change_authed_machines_modal(
     block_list: list[dict] = []
 
     # Generate list of machines
-    all_machines = machines.all(cache=cache, config=config, machines=machine_list)
+    tool_summary = machines.summary(cache=cache, config=config, machines=machine_list)
+    all_machines = tool_summary["categories"]
     authed_machines = machines.user(
         id=user, cache=cache, config=config, machines=machine_list
     )
@@ -747,7 +706,8 @@ def trainer_change_authed_machines_modal(
 
 
 def tool_selector_modal(config, client, cache, machine_list):
-    all_machines = machines.all(cache=cache, config=config, machines=machine_list)
+    tool_summary = machines.summary(cache=cache, config=config, machines=machine_list)
+    all_machines = tool_summary["categories"]
 
     option_groups = []
 
@@ -918,7 +878,9 @@ def follow_up_buttons(machine, follow_up_days, operator_id, trainer_id, has_slac
     return block_list
 
 
-def placeholder_modal(text: str = "Loading... :loading-disc:") -> dict:
+def placeholder_modal(
+    text: str = "Loading... :loading-disc:", title: str = "Loading..."
+) -> dict:
     """Returns a placeholder loading modal"""
 
     block_list = []
@@ -930,7 +892,7 @@ def placeholder_modal(text: str = "Loading... :loading-disc:") -> dict:
 
     # Create modal
     modal = copy(blocks.modal)
-    modal["title"]["text"] = "Loading..."
+    modal["title"]["text"] = title
     modal["blocks"] = block_list
     modal["callback_id"] = "placeholder_modal"
     return modal
@@ -0,0 +1,132 @@
+import atexit
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+
+# Set up logging
+logger = logging.getLogger("leader")
+
+# Leases are rows in a SQLite database that all instances can reach, either on one host or on shared storage
+# Expiry times are wall clock times so hosts sharing a lease database need their clocks in sync
+
+# Distinguishes instances on hosts where a pid might be reused
+_nonce = uuid.uuid4().hex[:6]
+
+_path: str | None = None
+_name = ""
+_ttl = 30.0
+_valid_until = 0.0
+
+
+def holder_id() -> str:
+    """Identifies this process in the lease table. Worked out each time since forked processes share module state."""
+    return f"{socket.gethostname()}:{os.getpid()}:{_nonce}"
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, timeout=10, isolation_level=None)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS lease (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires REAL NOT NULL)"
+    )
+    return connection
+
+
+def acquire(path: str, name: str, ttl: float) -> bool:
+    """Take or renew the named lease for ttl seconds. Returns whether we now hold it."""
+    now = time.time()
+    with closing(_connect(path)) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        row = connection.execute(
+            "SELECT holder, expires FROM lease WHERE name = ?", (name,)
+        ).fetchone()
+        if row and row[0] != holder_id() and row[1] > now:
+            connection.execute("ROLLBACK")
+            return False
+        connection.execute(
+            "INSERT OR REPLACE INTO lease (name, holder, expires) VALUES (?, ?, ?)",
+            (name, holder_id(), now + ttl),
+        )
+        connection.execute("COMMIT")
+    return True
+
+
+def release(path: str, name: str) -> None:
+    """Give up the named lease if we hold it so another instance can take over straight away."""
+    with closing(_connect(path)) as connection:
+        connection.execute(
+            "DELETE FROM lease WHERE name = ? AND holder = ?", (name, holder_id())
+        )
+
+
+def holder(path: str, name: str) -> str | None:
+    """Who currently holds the named lease, if anyone."""
+    with closing(_connect(path)) as connection:
+        row = connection.execute(
+            "SELECT holder FROM lease WHERE name = ? AND expires > ?",
+            (name, time.time()),
+        ).fetchone()
+    return row[0] if row else None
+
+
+def claim(path: str, name: str, period: float) -> bool:
+    """Claim a scheduled job (eg a cron run) for period seconds so other instances skip theirs.
+
+    The claim isn't released when the job finishes, otherwise an instance whose cron runs a little later would run it again.
+    """
+    try:
+        claimed = acquire(path=path, name=name, ttl=period)
+    except sqlite3.Error:
+        logger.exception(f"Could not claim {name}, running it anyway")
+        return True
+    if not claimed:
+        logger.info(f"{name} has already been claimed by {holder(path, name)}")
+    return claimed
+
+
+def _renew() -> None:
+    global _valid_until
+    leading = False
+    while True:
+        attempted = time.time()
+        try:
+            acquired = acquire(path=_path, name=_name, ttl=_ttl)  # type: ignore
+        except sqlite3.Error:
+            logger.exception("Could not renew leader lease")
+            acquired = False
+
+        if acquired:
+            # Stop acting as leader a little before the lease runs out in case renewals stall
+            _valid_until = attempted + _ttl * 2 / 3
+        else:
+            _valid_until = 0.0
+
+        if acquired != leading:
+            leading = acquired
+            if leading:
+                logger.info(f"Elected leader for {_name} as {holder_id()}")
+            else:
+                logger.warning(f"No longer leader for {_name}")
+        time.sleep(_ttl / 3)
+
+
+def start(path: str, name: str, ttl: float = 30) -> None:
+    """Take part in leader election for name, renewing the lease every ttl/3 seconds in the background.
+
+    If the leader dies another instance takes over within ttl seconds, or straight away if it shuts down cleanly.
+    """
+    global _path, _name, _ttl
+    _path, _name, _ttl = path, name, ttl
+    threading.Thread(target=_renew, name="leader", daemon=True).start()
+    atexit.register(lambda: release(path=path, name=name))
+
+
+def is_leader() -> bool:
+    """Whether this instance should run scheduled work. Always true if leader election hasn't been started."""
+    if not _path:
+        return True
+    return time.time() < _valid_until
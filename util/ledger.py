@@ -0,0 +1,155 @@
+import logging
+import sqlite3
+import time
+from contextlib import closing
+
+# Set up logging
+logger = logging.getLogger("ledger")
+
+# Sign offs that need a follow up with the operator, so reminders don't depend on reading back Slack history
+# Instances can share one ledger on one host or shared storage (like leader.py). A reminder is only sent by the instance that claims it
+
+_columns = (
+    "id",
+    "channel",
+    "thread_ts",
+    "trainer",
+    "operator",
+    "operator_ref",
+    "operator_mention",
+    "machine",
+    "machine_name",
+    "signed_off",
+    "due",
+    "status",
+)
+
+_schema = """CREATE TABLE IF NOT EXISTS sign_offs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel TEXT NOT NULL,
+    thread_ts TEXT,
+    trainer TEXT NOT NULL,
+    operator TEXT NOT NULL,
+    operator_ref TEXT NOT NULL,
+    operator_mention TEXT NOT NULL,
+    machine INTEGER NOT NULL,
+    machine_name TEXT NOT NULL,
+    signed_off REAL NOT NULL,
+    due REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    updated REAL
+)"""
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, timeout=10, isolation_level=None)
+    connection.execute(_schema)
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS sign_offs_due ON sign_offs (status, due)"
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS sign_offs_operator ON sign_offs (operator, machine)"
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS sign_offs_operator_ref ON sign_offs (operator_ref, machine)"
+    )
+    return connection
+
+
+def record(path: str, **sign_off) -> dict:
+    """Add a sign off that needs a follow up at sign_off["due"], returning it with its ledger ID."""
+    fields = [column for column in _columns if column in sign_off]
+    with closing(_connect(path)) as connection:
+        cursor = connection.execute(
+            f"INSERT INTO sign_offs ({', '.join(fields)}) VALUES ({', '.join('?' for _ in fields)})",
+            [sign_off[field] for field in fields],
+        )
+        sign_off_id = cursor.lastrowid
+    return {**sign_off, "id": sign_off_id, "status": "pending"}
+
+
+def pending(path: str, lease: float) -> list[dict]:
+    """Every sign off still waiting for its follow up, including overdue ones, soonest first.
+
+    Includes follow ups claimed more than lease seconds ago that were never marked as sent, eg because the instance sending them died.
+    """
+    with closing(_connect(path)) as connection:
+        rows = connection.execute(
+            f"SELECT {', '.join(_columns)} FROM sign_offs WHERE status = 'pending' OR (status = 'sending' AND updated < ?) ORDER BY due",
+            (time.time() - lease,),
+        ).fetchall()
+    return [dict(zip(_columns, row)) for row in rows]
+
+
+def get(path: str, sign_off_id: int) -> dict | None:
+    with closing(_connect(path)) as connection:
+        row = connection.execute(
+            f"SELECT {', '.join(_columns)} FROM sign_offs WHERE id = ?",
+            (sign_off_id,),
+        ).fetchone()
+    return dict(zip(_columns, row)) if row else None
+
+
+def claim(path: str, sign_off_id: int, lease: float) -> bool:
+    """Claim a follow up to send for lease seconds. Returns False if it's been sent, resolved or claimed by someone else, so each one is only sent once.
+
+    A claim that's held longer than lease without being marked as sent can be taken over.
+    """
+    now = time.time()
+    with closing(_connect(path)) as connection:
+        cursor = connection.execute(
+            "UPDATE sign_offs SET status = 'sending', updated = ? WHERE id = ? AND (status = 'pending' OR (status = 'sending' AND updated < ?))",
+            (now, sign_off_id, now - lease),
+        )
+    return cursor.rowcount == 1
+
+
+def sent(path: str, sign_off_id: int) -> None:
+    """Mark a claimed follow up as sent."""
+    with closing(_connect(path)) as connection:
+        connection.execute(
+            "UPDATE sign_offs SET status = 'sent', updated = ? WHERE id = ? AND status = 'sending'",
+            (time.time(), sign_off_id),
+        )
+
+
+def retry(path: str, sign_off_id: int, due: float) -> None:
+    """Put a claimed follow up back to be sent at due after sending it failed."""
+    with closing(_connect(path)) as connection:
+        connection.execute(
+            "UPDATE sign_offs SET status = 'pending', due = ?, updated = ? WHERE id = ? AND status = 'sending'",
+            (due, time.time(), sign_off_id),
+        )
+
+
+def set_thread(path: str, ref: str, ts: str | None) -> int:
+    """Replace an outbox reference used as thread_ts with the ts of the delivered message, so any instance can reply in the thread."""
+    with closing(_connect(path)) as connection:
+        cursor = connection.execute(
+            "UPDATE sign_offs SET thread_ts = ?, updated = ? WHERE thread_ts = ?",
+            (ts, time.time(), ref),
+        )
+    return cursor.rowcount
+
+
+def resolve(path: str, operator_ref: str, machine) -> int:
+    """Mark follow ups for an operator and machine as done, eg once a trainer has used the check in buttons.
+
+    operator_ref is the operator's Slack ID, or their TidyHQ contact ID if they don't have one. Returns how many were resolved.
+    """
+    with closing(_connect(path)) as connection:
+        cursor = connection.execute(
+            "UPDATE sign_offs SET status = 'resolved', updated = ? WHERE operator_ref = ? AND machine = ? AND status = 'pending'",
+            (time.time(), str(operator_ref), int(machine)),
+        )
+    return cursor.rowcount
+
+
+def recorded(path: str, operator, machine) -> bool:
+    """Whether a sign off of a TidyHQ contact on a machine is already in the ledger."""
+    with closing(_connect(path)) as connection:
+        row = connection.execute(
+            "SELECT 1 FROM sign_offs WHERE operator = ? AND machine = ? LIMIT 1",
+            (str(operator), int(machine)),
+        ).fetchone()
+    return row is not None
@@ -5,6 +5,9 @@ import logging
 # Set up logging
 logger = logging.getLogger("machines")
 
+# Precomputed summaries, keyed by cache generation and machine list
+_summaries: dict = {}
+
 
 def all(cache, config, machines):
     categories = machines
@@ -25,6 +28,71 @@ def all(cache, config, machines):
     return rich_categories
 
 
+def summary(cache, config, machines) -> dict:
+    """Precompute the per-category machine sets and totals used by the home and category modals.
+
+    These are the same for every user so they're calculated once per cache generation. Renders only need to intersect a user's sign offs against them.
+    """
+    key = (tidyhq.generation(cache), id(machines))
+    result = _summaries.get(key)
+    if result:
+        return result
+
+    categories = all(cache=cache, config=config, machines=machines)
+
+    machine_sets = {}
+    probationary = {}
+    totals = {}
+    for category in categories:
+        machine_sets[category] = {machine["id"] for machine in categories[category]}
+        probationary[category] = {
+            machine["id"]
+            for machine in categories[category]
+            if machine.get("level", "⚪") == "🅿️"
+        }
+        # Probationary sign offs are only counted for users that hold them
+        totals[category] = len(machine_sets[category] - probationary[category])
+
+    all_machines = set().union(*machine_sets.values())
+    all_probationary = set().union(*probationary.values())
+
+    result = {
+        "categories": categories,
+        "machines": machine_sets,
+        "probationary": probationary,
+        "totals": totals,
+        "all": all_machines,
+        "all_probationary": all_probationary,
+        "all_total": len(all_machines - all_probationary),
+    }
+
+    # Only the current generation is useful
+    _summaries.clear()
+    _summaries[key] = result
+    logger.debug(
+        f"Precomputed summary of {len(all_machines)} machines in {len(categories)} categories"
+    )
+
+    return result
+
+
+def restore_summary(cache, machines, result: dict) -> None:
+    """Reuse a summary computed for this cache and machine list by a previous process (see snapshot.py)."""
+    _summaries.clear()
+    _summaries[(tidyhq.generation(cache), id(machines))] = result
+
+
+def user_total(machine_summary: dict, category: str | None, authed: set) -> int:
+    """Total machines in a category (or all categories if None) for a user with the provided sign offs."""
+    if category is None:
+        return machine_summary["all_total"] + len(
+            authed & machine_summary["all_probationary"]
+        )
+    return machine_summary["totals"][category] + len(
+        authed & machine_summary["probationary"][category]
+    )
+
+
 def user(id, cache, config, machines):
     categories = machines
 
@@ -0,0 +1,233 @@
+import logging
+import threading
+import time
+from functools import wraps
+from typing import TYPE_CHECKING, Callable
+
+from . import tracing
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+# Set up logging
+logger = logging.getLogger("metrics")
+
+# Upper bounds (in seconds) of the latency histogram buckets
+buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Metrics are keyed by name and a sorted tuple of label pairs
+_counters: dict[tuple[str, tuple], float] = {}
+_histograms: dict[tuple[str, tuple], dict] = {}
+_gauges: dict[str, Callable[[], float | None]] = {}
+_lock = threading.Lock()
+
+# Histogram counts as of the last log summary, so each summary covers just its own interval
+_summarised: dict[tuple[str, tuple], dict] = {}
+
+
+def _key(name: str, labels: dict) -> tuple[str, tuple]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, amount: float = 1, **labels) -> None:
+    """Increment a counter."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name: str, seconds: float, **labels) -> None:
+    """Record a duration in a latency histogram."""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if not histogram:
+            histogram = {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+            _histograms[key] = histogram
+        for i, bound in enumerate(buckets):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+                break
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+
+def gauge(name: str, read: Callable[[], float | None]) -> None:
+    """Register a gauge. read() is called whenever metrics are exported and can return None if there's no value yet."""
+    with _lock:
+        _gauges[name] = read
+
+
+def external_call(service: str, endpoint: str, status, seconds: float) -> None:
+    """Record a call to an external API (eg TidyHQ or Slack)."""
+    observe("external_call_seconds", seconds, service=service, endpoint=endpoint)
+    inc("external_calls_total", service=service, endpoint=endpoint, status=status)
+
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    inc("cache_lookups_total", cache=cache, result="hit" if hit else "miss")
+
+
+def handler(func: Callable) -> Callable:
+    """Time a Bolt listener, labelled with the function name, and start a trace for the payload.
+
+    Bolt inspects the wrapped function's arguments so the listener still gets what it asks for.
+    """
+
+    @wraps(func)
+    def timed(*args, **kwargs):
+        start = time.time()
+        status = "error"
+        payload = kwargs.get("body") or kwargs.get("event") or {}
+        user = payload.get("user_id") or payload.get("user")
+        try:
+            with tracing.trace(
+                func.__name__,
+                payload=payload.get("type"),
+                user=user.get("id") if isinstance(user, dict) else user,
+            ):
+                result = func(*args, **kwargs)
+            status = "ok"
+            return result
+        finally:
+            observe("handler_seconds", time.time() - start, handler=func.__name__)
+            inc("handler_calls_total", handler=func.__name__, status=status)
+
+    return timed
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: tuple, extra: dict | None = None) -> str:
+    pairs = list(labels) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = [f'{k}="{_escape(v)}"' for k, v in pairs]
+    return "{" + ",".join(escaped) + "}"
+
+
+def render() -> str:
+    """Export all metrics in the Prometheus text format."""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {
+            key: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]}
+            for key, h in _histograms.items()
+        }
+        gauges = dict(_gauges)
+
+    lines = []
+    typed = set()
+
+    for (name, labels), value in sorted(counters.items()):
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{_labels(labels)} {value}")
+
+    for (name, labels), histogram in sorted(histograms.items()):
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        cumulative = 0
+        for bound, count in zip(buckets, histogram["buckets"]):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(labels, {'le': bound})} {cumulative}")
+        lines.append(
+            f"{name}_bucket{_labels(labels, {'le': '+Inf'})} {histogram['count']}"
+        )
+        lines.append(f"{name}_sum{_labels(labels)} {histogram['sum']}")
+        lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+
+    for name, read in sorted(gauges.items()):
+        try:
+            value = read()
+        except Exception:
+            logger.exception(f"Could not read gauge {name}")
+            continue
+        if value is None:
+            continue
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def serve(port: int, host: str = "127.0.0.1") -> "ThreadingHTTPServer":
+    """Serve /metrics on a background thread."""
+    # http.server is slow to import and only long running processes serve metrics
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header(
+                "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+            )
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+def _percentile(counts: list[int], total: int, fraction: float) -> str:
+    """Approximate a percentile as the upper bound of the bucket it falls in."""
+    seen = 0
+    for bound, count in zip(buckets, counts):
+        seen += count
+        if seen >= total * fraction:
+            return f"<{bound}s"
+    return f">{buckets[-1]}s"
+
+
+def summary() -> list[str]:
+    """Describe each latency histogram since the last summary."""
+    lines = []
+    with _lock:
+        for key, histogram in sorted(_histograms.items()):
+            last = _summarised.get(
+                key, {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+            )
+            count = histogram["count"] - last["count"]
+            if count:
+                counts = [
+                    now - then
+                    for now, then in zip(histogram["buckets"], last["buckets"])
+                ]
+                average = (histogram["sum"] - last["sum"]) / count
+                name, labels = key
+                lines.append(
+                    f"{name}{_labels(labels)}: {count} calls, avg {average:.3f}s, p50 {_percentile(counts, count, 0.5)}, p95 {_percentile(counts, count, 0.95)}"
+                )
+            _summarised[key] = {
+                "buckets": list(histogram["buckets"]),
+                "sum": histogram["sum"],
+                "count": histogram["count"],
+            }
+    return lines
+
+
+def log_summaries(interval: float) -> None:
+    """Log a latency summary every interval seconds on a background thread."""
+
+    def run():
+        while True:
+            time.sleep(interval)
+            lines = summary()
+            if lines:
+                logger.info("Latency over the last interval:\n" + "\n".join(lines))
+
+    threading.Thread(target=run, name="metrics-summary", daemon=True).start()
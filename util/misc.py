@@ -1,4 +1,3 @@
-import requests
 import logging
 
 # Set up logging
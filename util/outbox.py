@@ -0,0 +1,302 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, Callable
+
+from slack_sdk.errors import SlackApiError
+
+from . import ratelimit
+
+# Set up logging
+logger = logging.getLogger("outbox")
+
+# Messages are spooled to disk before sending so they survive restarts
+# Each line of the spool is one of:
+# {"op": "queue", "id": ..., "key": ..., "params": {...}, "time": ...}
+# {"op": "sent", "id": ..., "ts": ...}
+# {"op": "dropped", "id": ..., "error": ...}
+spool_file = "outbox.jsonl"
+
+# Prefix for the references returned by enqueue. These can be used as thread_ts for later messages
+ref_prefix = "outbox:"
+
+# How many delivered message timestamps to remember for resolving references
+delivered_size = 1000
+
+# Errors that won't go away by retrying
+permanent_errors = {
+    "channel_not_found",
+    "invalid_arguments",
+    "invalid_blocks",
+    "invalid_metadata_format",
+    "is_archived",
+    "msg_too_long",
+    "no_text",
+    "not_in_channel",
+    "user_not_found",
+}
+
+_deliver: Callable[[dict], str | None] | None = None
+_queues: OrderedDict[str, deque] = OrderedDict()
+_retry_at: dict[str, float] = {}
+_attempts: dict[str, int] = {}
+_delivered: OrderedDict[str, str | None] = OrderedDict()
+_waiting: dict[str, list[Callable[[str | None], None]]] = {}
+_stats = {"sent": 0, "retried": 0, "dropped": 0}
+_lock = threading.Condition()
+_spool_lock = threading.Lock()
+
+
+def _append(record: dict) -> None:
+    with _spool_lock:
+        with open(spool_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _remember(message_id: str, ts: str | None) -> None:
+    _delivered[message_id] = ts
+    while len(_delivered) > delivered_size:
+        _delivered.popitem(last=False)
+
+
+def _load() -> None:
+    """Rebuild the queues from the spool and compact it."""
+    pending: OrderedDict[str, dict] = OrderedDict()
+    try:
+        with open(spool_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    # Most likely a partial write during a crash
+                    logger.warning("Skipping invalid line in outbox spool")
+                    continue
+                if record["op"] == "queue":
+                    pending[record["id"]] = record
+                else:
+                    pending.pop(record["id"], None)
+                    _remember(record["id"], record.get("ts"))
+    except FileNotFoundError:
+        pass
+
+    _queues.clear()
+    for record in pending.values():
+        _queues.setdefault(record["key"], deque()).append(record)
+
+    # Rewrite the spool with just what we still need
+    with _spool_lock:
+        with open(f"{spool_file}.tmp", "w") as f:
+            for message_id, ts in _delivered.items():
+                f.write(json.dumps({"op": "sent", "id": message_id, "ts": ts}) + "\n")
+            for record in pending.values():
+                f.write(json.dumps(record) + "\n")
+        os.replace(f"{spool_file}.tmp", spool_file)
+
+    if pending:
+        logger.info(f"Loaded {len(pending)} unsent messages from the outbox")
+
+
+def start(deliver: Callable[[dict], str | None]) -> None:
+    """Load any unsent messages and start delivering them in the background.
+
+    deliver is called with the queued params and should return the ts of the sent message.
+    """
+    global _deliver
+    with _lock:
+        _load()
+        _deliver = deliver
+    threading.Thread(target=_sender, name="outbox", daemon=True).start()
+    logger.info("Outbox started")
+
+
+def running() -> bool:
+    return _deliver is not None
+
+
+def enqueue(key: str, params: dict) -> str:
+    """Queue a message for delivery. Messages with the same key (typically the channel) are delivered in order.
+
+    Returns a reference that can be used as the thread_ts of later queued messages.
+    """
+    record = {
+        "op": "queue",
+        "id": uuid.uuid4().hex,
+        "key": key,
+        "params": params,
+        "time": time.time(),
+    }
+    # Spooled and queued together so messages come back in the same order after a restart
+    with _lock:
+        _append(record)
+        _queues.setdefault(key, deque()).append(record)
+        _lock.notify()
+    return ref_prefix + record["id"]
+
+
+def is_ref(value: Any) -> bool:
+    return isinstance(value, str) and value.startswith(ref_prefix)
+
+
+def resolve(ref: str) -> tuple[bool, str | None]:
+    """Look up the ts of a queued message. Returns (delivered, ts)."""
+    with _lock:
+        message_id = ref[len(ref_prefix) :]
+        if message_id in _delivered:
+            return True, _delivered[message_id]
+        return False, None
+
+
+def is_pending(ref: str) -> bool:
+    """Whether a queued message is still waiting to be delivered by this outbox."""
+    with _lock:
+        return _is_queued(ref[len(ref_prefix) :])
+
+
+def when_delivered(ref: str, callback: Callable[[str | None], None]) -> bool:
+    """Call callback with the ts of a queued message once it's been delivered, or None if it was dropped.
+
+    Returns False without calling it if this outbox doesn't know about the message, eg it was queued by another instance.
+    """
+    message_id = ref[len(ref_prefix) :]
+    with _lock:
+        if message_id not in _delivered:
+            if not _is_queued(message_id):
+                return False
+            _waiting.setdefault(message_id, []).append(callback)
+            return True
+        ts = _delivered[message_id]
+    callback(ts)
+    return True
+
+
+def _is_queued(message_id: str) -> bool:
+    return any(
+        record["id"] == message_id for queue in _queues.values() for record in queue
+    )
+
+
+def _ready(key: str, now: float) -> bool:
+    if _retry_at.get(key, 0) > now:
+        return False
+    thread_ts = _queues[key][0]["params"].get("thread_ts")
+    if is_ref(thread_ts) and thread_ts[len(ref_prefix) :] not in _delivered:
+        # Wait for the parent message, unless it's been lost entirely (the reply is dropped)
+        return not _is_queued(thread_ts[len(ref_prefix) :])
+    return True
+
+
+def _sender() -> None:
+    while True:
+        with _lock:
+            now = time.time()
+            ready = [key for key in _queues if _queues[key] and _ready(key, now)]
+            if not ready:
+                # Sleep until the next retry is due or something new is queued
+                waits = [
+                    _retry_at[key] - now
+                    for key in _queues
+                    if _queues[key] and key in _retry_at
+                ]
+                _lock.wait(timeout=max(0.1, min(waits)) if waits else None)
+                continue
+            key = ready[0]
+            record = _queues[key][0]
+            params = dict(record["params"])
+            parent_lost = False
+            if is_ref(params.get("thread_ts")):
+                params["thread_ts"] = _delivered.get(
+                    params["thread_ts"][len(ref_prefix) :]
+                )
+                parent_lost = not params["thread_ts"]
+
+        if parent_lost:
+            # A reply on its own in the channel would make no sense
+            _finish(key, record, op="dropped", error="parent_not_delivered")
+            logger.error(f"Dropped queued reply to {key}, its parent wasn't delivered")
+            continue
+
+        try:
+            ts = _deliver(params)  # type: ignore
+        except SlackApiError as e:
+            error = e.response.get("error")
+            if error in permanent_errors:
+                _finish(key, record, op="dropped", error=error)
+                logger.error(f"Dropped queued message to {key}: {error}")
+                continue
+            if e.response.status_code == 429:
+                delay = ratelimit.retry_after_seconds(e.response.headers)
+            else:
+                delay = _backoff(key)
+            _retry(key, delay, error)
+            continue
+        except Exception as e:
+            _retry(key, _backoff(key), str(e))
+            continue
+
+        _finish(key, record, op="sent", ts=ts)
+
+
+def _backoff(key: str) -> float:
+    return min(300, 2 ** _attempts.get(key, 0))
+
+
+def _retry(key: str, delay: float, error: str | None) -> None:
+    with _lock:
+        _attempts[key] = _attempts.get(key, 0) + 1
+        _retry_at[key] = time.time() + delay
+        _stats["retried"] += 1
+    logger.warning(
+        f"Failed to send queued message to {key} ({error}), retrying in {delay}s"
+    )
+
+
+def _finish(key: str, record: dict, op: str, **details) -> None:
+    _append({"op": op, "id": record["id"], **details})
+    with _lock:
+        _queues[key].popleft()
+        if _queues[key]:
+            # Give other channels a turn
+            _queues.move_to_end(key)
+        else:
+            del _queues[key]
+        _attempts.pop(key, None)
+        _retry_at.pop(key, None)
+        _remember(record["id"], details.get("ts"))
+        if details.get("ts"):
+            # Replies waiting behind other messages can't lose their parent's ts once it's forgotten
+            for queue in _queues.values():
+                for queued in queue:
+                    if queued["params"].get("thread_ts") == ref_prefix + record["id"]:
+                        queued["params"] = {
+                            **queued["params"],
+                            "thread_ts": details["ts"],
+                        }
+        _stats["sent" if op == "sent" else "dropped"] += 1
+        _lock.notify()
+        callbacks = _waiting.pop(record["id"], [])
+    for callback in callbacks:
+        try:
+            callback(details.get("ts"))
+        except Exception:
+            logger.exception(f"Delivery callback for {record['id']} failed")
+
+
+def depth() -> int:
+    """Number of messages waiting to be delivered."""
+    with _lock:
+        return sum(len(queue) for queue in _queues.values())
+
+
+def stats() -> dict[str, int]:
+    with _lock:
+        return dict(
+            _stats,
+            queued=sum(len(queue) for queue in _queues.values()),
+            channels=len(_queues),
+        )
@@ -0,0 +1,78 @@
+import cProfile
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from functools import wraps
+from typing import Any, Callable
+
+# Set up logging
+logger = logging.getLogger("profiling")
+
+# Directory profile dumps are written to, open them with pstats or snakeviz
+profile_dir = "profiles"
+
+# Names of the handlers and tasks currently being profiled, "all" profiles everything
+_targets: set[str] = set()
+
+# Only one profile runs at a time. Nested or concurrent work is left unprofiled rather than failing
+_running = threading.Lock()
+
+
+def enable(names: list[str]) -> None:
+    _targets.update(names)
+    logger.info(f"Profiling {', '.join(sorted(_targets))}")
+
+
+def disable(names: list[str] | None = None) -> None:
+    """Stop profiling the named targets, or everything if no names are given."""
+    if names is None:
+        _targets.clear()
+    else:
+        _targets.difference_update(names)
+    logger.info(
+        f"Profiling {', '.join(sorted(_targets))}" if _targets else "Profiling off"
+    )
+
+
+def targets() -> set[str]:
+    return set(_targets)
+
+
+def call(name: str, fn: Callable, *args, **kwargs) -> Any:
+    """Run fn(*args, **kwargs), writing a profile dump if name is being profiled."""
+    # An empty set check is all this costs while profiling is off
+    if not _targets or (name not in _targets and "all" not in _targets):
+        return fn(*args, **kwargs)
+
+    if not _running.acquire(blocking=False):
+        logger.debug(f"Another profile is running, not profiling {name}")
+        return fn(*args, **kwargs)
+
+    profiler = cProfile.Profile()
+    start = time.time()
+    try:
+        return profiler.runcall(fn, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        _running.release()
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(
+            profile_dir, f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.prof"
+        )
+        profiler.dump_stats(path)
+        logger.info(f"Profiled {name} ({elapsed:.2f}s) to {path}")
+
+
+def profiled(name: str) -> Callable:
+    """Decorator version of call."""
+
+    def decorator(fn: Callable) -> Callable:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            return call(name, fn, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
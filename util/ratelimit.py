@@ -0,0 +1,188 @@
+import logging
+import threading
+import time
+from typing import Any
+
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.client import WebClient  # for typing
+
+from . import metrics, tracing
+
+# Set up logging
+logger = logging.getLogger("ratelimit")
+
+# Requests per minute allowed by each Slack rate limit tier
+tiers = {1: 1, 2: 20, 3: 50, 4: 100}
+
+# Rate limit tier of each Slack method we use. Unlisted methods are treated as tier 3
+# chat.postMessage is limited per channel rather than by tier, tier 4 keeps us well under the workspace limit
+method_tiers = {
+    "auth.test": 4,
+    "chat.postMessage": 4,
+    "chat.update": 3,
+    "conversations.history": 3,
+    "conversations.open": 3,
+    "conversations.replies": 3,
+    "usergroups.list": 2,
+    "users.info": 4,
+    "users.list": 2,
+    "views.open": 4,
+    "views.publish": 4,
+    "views.push": 4,
+    "views.update": 4,
+}
+
+# Calls made while a user is waiting (modals, message updates) go ahead of background work (home fan-outs, queued notifications)
+priorities = ("interactive", "background")
+
+# Fraction of each bucket's burst capacity that background calls leave for interactive ones
+background_reserve = 0.2
+
+# Fraction of each tier this process may use. Buckets are per process, so processes sharing one Slack app split the limits between them (see share_with)
+share = 1.0
+
+
+class TokenBucket:
+    """Allow up to rate requests per minute with short bursts.
+
+    Background requests wait while any interactive request is waiting and never use the last part of the burst capacity.
+    """
+
+    def __init__(self, rate: int, burst_seconds: int = 5):
+        self.rate = rate / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.reserve = min(self.capacity * background_reserve, self.capacity - 1)
+        self.interactive_waiting = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority: str = "interactive") -> None:
+        """Block until a request of the given priority can be made."""
+        if priority not in priorities:
+            raise ValueError(f"Unknown priority {priority}")
+        interactive = priority == "interactive"
+
+        with self.lock:
+            if interactive:
+                self.interactive_waiting += 1
+        try:
+            while True:
+                with self.lock:
+                    now = time.monotonic()
+                    self._refill(now)
+                    needed = 1 if interactive else 1 + self.reserve
+                    yielding = not interactive and self.interactive_waiting > 0
+                    if (
+                        now >= self.paused_until
+                        and self.tokens >= needed
+                        and not yielding
+                    ):
+                        self.tokens -= 1
+                        return
+                    wait = max(
+                        self.paused_until - now, (needed - self.tokens) / self.rate
+                    )
+                    if yielding:
+                        # Check back once the interactive request has had a chance to go
+                        wait = max(wait, 1 / self.rate)
+                time.sleep(wait)
+        finally:
+            if interactive:
+                with self.lock:
+                    self.interactive_waiting -= 1
+
+    def pause(self, seconds: float) -> None:
+        """Stop all requests for a period, typically because Slack told us to."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+_buckets: dict[str, TokenBucket] = {}
+_buckets_lock = threading.Lock()
+
+
+def bucket(method: str) -> TokenBucket:
+    with _buckets_lock:
+        if method not in _buckets:
+            _buckets[method] = TokenBucket(
+                rate=tiers[method_tiers.get(method, 3)] * share
+            )
+        return _buckets[method]
+
+
+def share_with(processes: int) -> None:
+    """Use 1/processes of each tier, eg in each of several HTTP worker processes."""
+    global share
+    with _buckets_lock:
+        share = 1 / max(1, processes)
+        # Buckets made before now have the full rate
+        _buckets.clear()
+    logger.info(f"Using 1/{max(1, processes)} of each Slack rate limit tier")
+
+
+def retry_after_seconds(headers: dict) -> int:
+    """Read the Retry-After header regardless of capitalisation, defaulting to 1 second."""
+    for key, value in headers.items():
+        if key.lower() == "retry-after":
+            if isinstance(value, list):
+                value = value[0]
+            try:
+                return int(value)
+            except ValueError:
+                break
+    return 1
+
+
+def call(
+    client: WebClient,
+    method: str,
+    max_retries: int = 5,
+    priority: str = "interactive",
+    **kwargs,
+) -> Any:
+    """Call a Slack Web API method (eg "views.publish") within its rate limit tier.
+
+    priority is "interactive" for calls a user is waiting on or "background" for work that can yield to them.
+
+    Requests that are rate limited anyway are retried after the Retry-After period Slack provides.
+    """
+    method_bucket = bucket(method)
+    func = getattr(client, method.replace(".", "_"))
+
+    attempt = 0
+    while True:
+        with tracing.span(f"slack {method}", priority=priority, attempt=attempt):
+            waiting = time.time()
+            method_bucket.acquire(priority=priority)
+            start = time.time()
+            metrics.observe(
+                "ratelimit_wait_seconds",
+                start - waiting,
+                method=method,
+                priority=priority,
+            )
+            tracing.annotate(waited=round(start - waiting, 3))
+            try:
+                response = func(**kwargs)
+                metrics.external_call("slack", method, "ok", time.time() - start)
+                return response
+            except SlackApiError as e:
+                metrics.external_call(
+                    "slack", method, e.response.get("error"), time.time() - start
+                )
+                tracing.annotate(error=e.response.get("error"))
+                if e.response.status_code != 429 or attempt >= max_retries:
+                    raise
+                retry_after = retry_after_seconds(e.response.headers)
+                logger.warning(
+                    f"Rate limited on {method}, retrying in {retry_after}s (attempt {attempt + 1}/{max_retries})"
+                )
+                method_bucket.pause(retry_after)
+                attempt += 1
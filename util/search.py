@@ -0,0 +1,127 @@
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from . import metrics, tidyhq
+
+# Set up logging
+logger = logging.getLogger("search")
+
+# Contact search index, keyed by cache generation
+_indexes: dict = {}
+
+# Recent query results, keyed by cache generation and normalised query
+_recent: OrderedDict = OrderedDict()
+_recent_lock = threading.Lock()
+recent_size = 256
+
+
+def normalise(text: str) -> str:
+    """Lowercase, strip accents and collapse whitespace so searches are forgiving."""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(text.lower().split())
+
+
+def trigrams(text: str) -> set[str]:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def build(cache: dict, config: dict) -> dict:
+    """Build (or return the already built) search index for the current cache generation."""
+    key = (tidyhq.generation(cache), id(cache))
+    index = _indexes.get(key)
+    if index:
+        return index
+
+    entries = {}
+    by_trigram: dict[str, set[int]] = {}
+    for contact in cache["contacts"]:
+        # Contacts can be in the cache twice, the first one wins
+        if contact["id"] in entries:
+            continue
+
+        name = tidyhq.format_contact(contact=contact)
+        normalised = normalise(name)
+        entries[contact["id"]] = {
+            "id": contact["id"],
+            "name": name,
+            "normalised": normalised,
+            "tokens": normalised.replace("(", " ").replace(")", " ").split(),
+            "existing": bool(
+                tidyhq.find_groups_for_user(contact=contact, config=config)
+            ),
+        }
+        for trigram in trigrams(normalised):
+            by_trigram.setdefault(trigram, set()).add(contact["id"])
+
+    index = {"entries": entries, "trigrams": by_trigram}
+    _indexes.clear()
+    _indexes[key] = index
+    logger.debug(
+        f"Indexed {len(entries)} contacts with {len(by_trigram)} trigrams for search"
+    )
+    return index
+
+
+def restore(cache: dict, index: dict) -> None:
+    """Reuse a search index built for this cache by a previous process (see snapshot.py)."""
+    _indexes.clear()
+    _indexes[(tidyhq.generation(cache), id(cache))] = index
+
+
+def _rank(entry: dict, query: str) -> tuple:
+    if entry["normalised"].startswith(query):
+        position = 0
+    elif any(token.startswith(query) for token in entry["tokens"]):
+        position = 1
+    else:
+        position = 2
+    return (position, entry["normalised"], entry["id"])
+
+
+def query(cache: dict, config: dict, text: str, limit: int = 100) -> list[dict]:
+    """Search contacts by name or nickname.
+
+    Returns up to limit entries (dicts with id, name and existing) ranked by whether the query matches the start of the name, the start of a word, or anywhere else.
+    """
+    search = normalise(text)
+    key = (tidyhq.generation(cache), id(cache), search, limit)
+
+    with _recent_lock:
+        if key in _recent:
+            _recent.move_to_end(key)
+            metrics.cache_lookup("search", hit=True)
+            return _recent[key]
+    metrics.cache_lookup("search", hit=False)
+
+    index = build(cache=cache, config=config)
+    entries = index["entries"]
+
+    if len(search) >= 3:
+        # Every trigram in the query must appear in the name
+        candidates = None
+        for trigram in trigrams(search):
+            postings = index["trigrams"].get(trigram, set())
+            candidates = postings if candidates is None else candidates & postings
+            if not candidates:
+                break
+        candidate_entries = [entries[contact_id] for contact_id in candidates or []]
+    else:
+        candidate_entries = list(entries.values())
+
+    # Trigrams can match out of order so confirm the whole query is present
+    matches = [entry for entry in candidate_entries if search in entry["normalised"]]
+    matches.sort(key=lambda entry: _rank(entry, search))
+    results = [
+        {"id": entry["id"], "name": entry["name"], "existing": entry["existing"]}
+        for entry in matches[:limit]
+    ]
+
+    with _recent_lock:
+        _recent[key] = results
+        while len(_recent) > recent_size:
+            _recent.popitem(last=False)
+
+    return results
@@ -1,12 +1,15 @@
+import json
 import logging
+import os
 from typing import Any
 from copy import deepcopy as copy
 from slack_sdk.web.client import WebClient  # for typing
 from slack_bolt import App  # for typing
-from pprint import pprint
+from slack_sdk.errors import SlackApiError
 
 from editable_resources import strings
-from . import formatters, blocks, tidyhq
+from . import formatters, blocks, followups, outbox, ratelimit, tidyhq, tracing
+import threading
 import time
 
 
@@ -14,6 +17,84 @@ import time
 
 logger = logging.getLogger("formatters")
 
+# Cached membership of the trainer user groups
+_trainers: dict[str, Any] = {"users": set(), "time": 0.0}
+_trainers_lock = threading.Lock()
+
+# Cached DM channel IDs, keyed by the users in the conversation. Persisted so it survives restarts
+dm_cache_file = "dm_channels.json"
+_dm_channels: dict[str, str] | None = None
+_dm_lock = threading.Lock()
+
+
+def _dm_key(users: str) -> str:
+    return ",".join(sorted(user.strip() for user in users.split(",")))
+
+
+def _load_dm_channels() -> dict[str, str]:
+    global _dm_channels
+    if _dm_channels is None:
+        try:
+            with open(dm_cache_file) as f:
+                _dm_channels = json.load(f)
+        except FileNotFoundError:
+            _dm_channels = {}
+        except json.decoder.JSONDecodeError:
+            logger.error("DM channel cache file is invalid")
+            _dm_channels = {}
+    return _dm_channels  # type: ignore
+
+
+def _save_dm_channels(key: str, channel: str | None) -> None:
+    """Add (or with channel=None remove) one DM channel and write the cache, keeping entries other worker processes have saved."""
+    global _dm_channels
+    try:
+        with open(dm_cache_file) as f:
+            channels = json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        channels = {}
+    channels.update(_dm_channels or {})
+    if channel:
+        channels[key] = channel
+    else:
+        channels.pop(key, None)
+    _dm_channels = channels
+
+    # Write to a temporary file first so a crash can't leave a half written cache, each process has its own
+    try:
+        with open(f"{dm_cache_file}.{os.getpid()}.tmp", "w") as f:
+            json.dump(channels, f)
+        os.replace(f"{dm_cache_file}.{os.getpid()}.tmp", dm_cache_file)
+    except OSError:
+        # Not worth failing a message over, the channel is looked up again next time
+        logger.exception("Could not save DM channel cache")
+
+
+def open_conversation(
+    client: WebClient, users: str, priority: str = "interactive"
+) -> str:
+    """Get the channel ID of a DM or group DM with a comma separated list of users, opening it if we haven't before."""
+    key = _dm_key(users)
+    with _dm_lock:
+        channels = _load_dm_channels()
+        if key in channels:
+            return channels[key]
+
+    r = ratelimit.call(client, "conversations.open", priority=priority, users=key)
+    channel = r.data["channel"]["id"]  # type: ignore
+
+    with _dm_lock:
+        _save_dm_channels(key, channel)
+    logger.debug(f"Cached DM channel {channel} for {key}")
+    return channel
+
+
+def forget_conversation(users: str) -> None:
+    """Remove a cached DM channel, typically because it no longer exists."""
+    with _dm_lock:
+        if _load_dm_channels().pop(_dm_key(users), None):
+            _save_dm_channels(_dm_key(users), None)
+
 
 def send(
     message: str,
@@ -23,8 +104,17 @@ def send(
     thread_ts: str | None = None,
     blocks: list | None = None,
     metadata: dict | None = None,
+    queue: bool = False,
+    priority: str = "interactive",
 ) -> str | None:
-    """Send a message to a Slack channel or user."""
+    """Send a message to a Slack channel or user.
+
+    slack_id can be a comma separated list of users to message them in a group DM.
+
+    With queue=True the message is added to the outbox (if it's running) and a reference that can be used as thread_ts for later queued messages is returned instead of a ts.
+
+    priority is passed on to ratelimit.call, queued messages are always sent as background work.
+    """
     if not app:
         raise Exception("Global Slack client not provided")
 
@@ -35,10 +125,27 @@ def send(
         if "event_type" not in metadata or "event_payload" not in metadata:
             raise Exception("Metadata must contain event_type and event_payload")
 
-    if slack_id and not channel:
-        # Open a DM with the user to get the channel ID
-        r = app.client.conversations_open(users=slack_id)
-        channel = r.data["channel"]["id"]  # type: ignore
+    # Replies to queued messages have to be queued too so they're sent after their parent
+    if outbox.is_ref(thread_ts):
+        delivered, ts = outbox.resolve(thread_ts)  # type: ignore
+        if delivered:
+            thread_ts = ts
+        else:
+            queue = True
+
+    if queue and outbox.running():
+        queued = {
+            "message": message,
+            "channel": channel,
+            "slack_id": slack_id,
+            "thread_ts": thread_ts,
+            "blocks": blocks,
+            "metadata": metadata,
+        }
+        return outbox.enqueue(
+            key=channel or _dm_key(slack_id),  # type: ignore
+            params={k: v for k, v in queued.items() if v is not None},
+        )
 
     # Prepare the parameters for the chat_postMessage call
     params = {
@@ -52,25 +159,76 @@ def send(
     # Remove keys with None values
     params = {k: v for k, v in params.items() if v is not None}
 
-    response = app.client.chat_postMessage(**params)
+    if slack_id and not channel:
+        # Look up the DM channel for the user(s)
+        params["channel"] = open_conversation(
+            client=app.client, users=slack_id, priority=priority
+        )
+        try:
+            response = ratelimit.call(
+                app.client, "chat.postMessage", priority=priority, **params
+            )
+        except SlackApiError as e:
+            if e.response.get("error") != "channel_not_found":
+                raise
+            # The cached channel is no longer valid, open a fresh one and try again
+            logger.info(f"Cached DM channel for {slack_id} not found, reopening")
+            forget_conversation(users=slack_id)
+            params["channel"] = open_conversation(
+                client=app.client, users=slack_id, priority=priority
+            )
+            response = ratelimit.call(
+                app.client, "chat.postMessage", priority=priority, **params
+            )
+    else:
+        response = ratelimit.call(
+            app.client, "chat.postMessage", priority=priority, **params
+        )
 
     return response.data["ts"]  # type: ignore
 
 
+def start_outbox(app: App) -> None:
+    """Start delivering messages sent with queue=True in the background."""
+    outbox.start(deliver=lambda params: send(app=app, priority="background", **params))
+
+
+def trainer_users(
+    client: WebClient, config: dict, force: bool = False, priority: str = "interactive"
+) -> set[str]:
+    """Return the Slack IDs of all members of the configured trainer groups.
+
+    usergroups.list is rate limited and returns every group in the workspace so the result is cached for config["trainer_cache_expiry"] seconds (default 5 minutes) or until invalidated.
+    """
+    with _trainers_lock:
+        age = time.time() - _trainers["time"]
+        if force or age > config.get("trainer_cache_expiry", 300):
+            r = ratelimit.call(
+                client, "usergroups.list", priority=priority, include_users=True
+            )
+            users = set()
+            for group in r.data["usergroups"]:  # type: ignore
+                if group["id"] in config["slack"]["trainers"]:
+                    users.update(group.get("users", []))
+            _trainers["users"] = users
+            _trainers["time"] = time.time()
+            logger.debug(f"Cached {len(users)} trainers")
+        return _trainers["users"]
+
+
+def invalidate_trainers() -> None:
+    """Force the next trainer check to fetch group membership from Slack."""
+    with _trainers_lock:
+        _trainers["time"] = 0.0
+
+
 def check_trainer(user, config, app=None, client=None):
     if app:
-        r = app.client.usergroups_list(include_users=True)
-    elif client:
-        r = client.usergroups_list(include_users=True)
-    else:
+        client = app.client
+    elif not client:
         raise Exception("Must provide either app or client")
 
-    groups: list[dict[str, Any]] = r.data["usergroups"]
-    for group in groups:
-        if group["id"] in config["slack"]["trainers"]:
-            if user in group["users"]:
-                return True
-    return False
+    return user in trainer_users(client=client, config=config)
 
 
 def updateHome(
@@ -79,22 +237,35 @@ def updateHome(
     config,
     cache,
     machine_raw,
+    home_blocks: list | None = None,
+    priority: str = "interactive",
+    trainers: set[str] | None = None,
 ) -> None:
+    """Publish a user's app home, rendering it unless prerendered blocks are provided.
+
+    Fan-outs should use priority="background" so they don't hold up users opening their own home, and pass trainers (from trainer_users) so it's fetched once rather than whenever the cached copy expires.
+    """
+    if home_blocks is None:
+        with tracing.span("render home"):
+            home_blocks = formatters.home(
+                user=user,
+                config=config,
+                client=client,
+                cache=cache,
+                machine_raw=machine_raw,
+                trainers=trainers,
+            )
     home_view = {
         "type": "home",
-        "blocks": formatters.home(
-            user=user,
-            config=config,
-            client=client,
-            cache=cache,
-            machine_raw=machine_raw,
-        ),
+        "blocks": home_blocks,
     }
-    client.views_publish(user_id=user, view=home_view)
+    ratelimit.call(
+        client, "views.publish", priority=priority, user_id=user, view=home_view
+    )
 
 
 def get_name(id, client: WebClient) -> str:
-    r = client.users_info(user=id)
+    r = ratelimit.call(client, "users.info", user=id)
     return r.data["user"]["profile"]["display_name"]  # type: ignore
 
 
@@ -160,13 +331,7 @@ def add_block(block_list: list, block: list | dict) -> list:
 
 
 def is_trainer(user, client, config):
-    r = client.usergroups_list(include_users=True)
-    groups = r.data["usergroups"]
-    for group in groups:
-        if group["id"] in config["slack"]["trainers"]:
-            if user in group["users"]:
-                return True
-    return False
+    return user in trainer_users(client=client, config=config)
 
 
 def notify_training(
@@ -180,47 +345,115 @@ def notify_training(
     app: App,
 ) -> bool:
     """Notify Slack channel and trainee of training changes."""
+    return notify_training_batch(
+        action=action,
+        trainee=trainee,
+        trainee_formatted=trainee_formatted,
+        trainee_slack_id=trainee_slack_id,
+        machines=[machine_info],
+        config=config,
+        trainer=trainer,
+        app=app,
+    )
 
-    message = f"{'✅' if action == 'add' else '🚫'}{trainee_formatted} has been {'authorised' if action == 'add' else 'deauthorised'} for {machine_info['name']} ({machine_info.get('level', '⚪')}) by <@{trainer}>"
+
+def notify_training_batch(
+    action: str,
+    trainee: str,
+    trainee_formatted: str,
+    trainee_slack_id: str | None,
+    machines: list[dict],
+    config: dict,
+    trainer: str,
+    app: App,
+) -> bool:
+    """Notify Slack channel and trainee of training changes to several machines with a single summary message.
+
+    The message metadata includes the first machine as "machine" (as for a single change) and every machine as "machines".
+    """
+    if not machines:
+        return True
+
+    machine_text = ", ".join(
+        f"{machine_info['name']} ({machine_info.get('level', '⚪')})"
+        for machine_info in machines
+    )
+    message = f"{'✅' if action == 'add' else '🚫'}{trainee_formatted} has been {'authorised' if action == 'add' else 'deauthorised'} for {machine_text} by <@{trainer}>"
 
     # Send a notification to the training channel
     thread_ts = send(
         app=app,
         channel=config["slack"]["notification_channel"],
         message=message,
+        queue=True,
         metadata={
             "event_type": f"training_{action}",
             "event_payload": {
                 "trainer": trainer,
                 "operator": trainee,
-                "machine": machine_info["id"],
+                "machine": machines[0]["id"],
+                "machines": [machine_info["id"] for machine_info in machines],
                 "action": action,
             },
         },
     )
 
-    # Log the change to file
+    # Log the changes to file
     with open("tidyhq_changes.log", "a") as f:
-        f.write(f"{time.time()},{trainer},{action},{trainee},{machine_info['id']}\n")
+        for machine_info in machines:
+            f.write(
+                f"{time.time()},{trainer},{action},{trainee},{machine_info['id']}\n"
+            )
 
-    # Check if this tool requires a follow up check in
-    if "first_use_check_in" in machine_info.keys() and action == "add":
-        send(
-            app=app,
-            channel=config["slack"]["notification_channel"],
-            message="This tool needs a follow up",
-            blocks=formatters.follow_up_buttons(
-                machine=machine_info,
-                follow_up_days=machine_info["first_use_check_in"],
-                operator_id=trainee_slack_id if trainee_slack_id else trainee,
-                trainer_id=trainer,
-                has_slack=trainee_slack_id is not None,
-            ),
-            thread_ts=thread_ts,
-        )
+    if action != "add":
+        return True
+
+    # Check if any tools require a follow up check in
+    for machine_info in machines:
+        if "first_use_check_in" in machine_info.keys():
+            send(
+                app=app,
+                channel=config["slack"]["notification_channel"],
+                message=f"{machine_info['name']} needs a follow up",
+                blocks=formatters.follow_up_buttons(
+                    machine=machine_info,
+                    follow_up_days=machine_info["first_use_check_in"],
+                    operator_id=trainee_slack_id if trainee_slack_id else trainee,
+                    trainer_id=trainer,
+                    has_slack=trainee_slack_id is not None,
+                ),
+                thread_ts=thread_ts,
+                queue=True,
+            )
+
+            # The reminder to the trainer is sent by followups.py when it's due
+            ledger_path = config.get("sign_off_ledger", "sign_offs.db")
+            if ledger_path:
+                signed_off = time.time()
+                followups.add(
+                    path=ledger_path,
+                    channel=config["slack"]["notification_channel"],
+                    thread_ts=thread_ts,
+                    trainer=trainer,
+                    operator=str(trainee),
+                    operator_ref=trainee_slack_id if trainee_slack_id else str(trainee),
+                    operator_mention=(
+                        f"<@{trainee_slack_id}>"
+                        if trainee_slack_id
+                        else trainee_formatted
+                    ),
+                    machine=int(machine_info["id"]),
+                    machine_name=machine_info["name"],
+                    signed_off=signed_off,
+                    due=signed_off + int(machine_info["first_use_check_in"]) * 86400,
+                )
+
+    # Check if any tools have a trainee message to send
+    messages_sent = []
+    for machine_info in machines:
+        if "trainee_message" not in machine_info.keys():
+            continue
 
-    # Check if this tool has a trainee message to send
-    if "trainee_message" in machine_info.keys() and action == "add":
         logging.info(f"Sending trainee message for {machine_info['name']}")
 
         if machine_info["trainee_message"] in strings.trainee_messages:
@@ -236,21 +469,31 @@ def notify_training(
 
             # Send the message to the trainee
             if trainee_slack_id:
-                send(message=message, app=app, slack_id=trainee_slack_id)
-
-            # Add a note to the sign off message
-            if thread_ts:
                 send(
-                    app=app,
-                    channel=config["slack"]["notification_channel"],
-                    message=f"A post training message has been sent to {trainee_formatted}",
-                    thread_ts=thread_ts,
+                    message=message, app=app, slack_id=trainee_slack_id, queue=True
                 )
+            messages_sent.append(machine_info["name"])
         else:
             logging.error(
                 f"Trainee message {machine_info['trainee_message']} not found in strings.trainee_messages"
             )
 
+    # Add a note to the sign off message
+    if messages_sent and thread_ts:
+        if len(machines) == 1:
+            note = f"A post training message has been sent to {trainee_formatted}"
+        elif len(messages_sent) == 1:
+            note = f"A post training message for {messages_sent[0]} has been sent to {trainee_formatted}"
+        else:
+            note = f"Post training messages for {', '.join(messages_sent)} have been sent to {trainee_formatted}"
+        send(
+            app=app,
+            channel=config["slack"]["notification_channel"],
+            message=note,
+            thread_ts=thread_ts,
+            queue=True,
+        )
+
     return True
 
 
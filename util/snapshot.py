@@ -0,0 +1,80 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import time
+
+from . import machines, search, tidyhq
+
+# Set up logging
+logger = logging.getLogger("snapshot")
+
+# The cache and everything the bot derives from it, so a restart can start serving without waiting on TidyHQ
+# Pickle keeps the indexes pointing at the same contact dicts as the cache
+snapshot_file = "snapshot.pickle"
+
+# Bump when the layout of the snapshot or anything in it changes
+format_version = 1
+
+
+def _fingerprint(config: dict) -> str:
+    """Snapshots are only valid for the TidyHQ settings they were built with."""
+    return hashlib.sha256(
+        json.dumps(config["tidyhq"], sort_keys=True).encode()
+    ).hexdigest()
+
+
+def save(cache: dict, config: dict, machine_list: dict) -> None:
+    start = time.time()
+    data = {
+        "format": format_version,
+        "fingerprint": _fingerprint(config),
+        "saved": time.time(),
+        "cache": cache,
+        "machine_list": machine_list,
+        "contact_index": tidyhq.index(cache=cache, config=config),
+        "search_index": search.build(cache=cache, config=config),
+        "summary": machines.summary(cache=cache, config=config, machines=machine_list),
+    }
+    # Each process writes its own temporary file so HTTP mode workers saving at once don't collide
+    temporary = f"{snapshot_file}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, snapshot_file)
+    except (OSError, RuntimeError, pickle.PicklingError):
+        # RuntimeError if a handler changed the cache mid dump, the next change will save it again
+        logger.exception("Could not save startup snapshot")
+        return
+    logger.debug(f"Saved startup snapshot in {time.time() - start:.2f}s")
+
+
+def load(config: dict) -> tuple[dict, dict] | None:
+    """Load the cache and machine list from the snapshot and restore the indexes built from them.
+
+    Returns None if there's no usable snapshot.
+    """
+    try:
+        with open(snapshot_file, "rb") as f:
+            data = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.warning("Startup snapshot is unreadable, ignoring it")
+        return None
+
+    if data.get("format") != format_version:
+        logger.info("Startup snapshot is from a different version, ignoring it")
+        return None
+    if data.get("fingerprint") != _fingerprint(config):
+        logger.info("TidyHQ config has changed since the startup snapshot, ignoring it")
+        return None
+
+    cache = data["cache"]
+    machine_list = data["machine_list"]
+    tidyhq.restore_index(cache=cache, tables=data["contact_index"])
+    search.restore(cache=cache, index=data["search_index"])
+    machines.restore_summary(cache=cache, machines=machine_list, result=data["summary"])
+    logger.info(f"Loaded startup snapshot saved {time.time() - data['saved']:.0f}s ago")
+    return cache, machine_list
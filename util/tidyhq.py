@@ -1,13 +1,25 @@
 from typing import Literal
-import requests
 import logging
 import sys
-from pprint import pprint
 import datetime
-from typing import Any
+from typing import Any, Callable
 import json
+import os
+import threading
+import time
 from copy import deepcopy as copy
 
+from . import cachestore, leader, metrics, profiling, tracing
+
+# Lookup tables derived from the cache, keyed by cache generation
+_indexes: dict = {}
+
+# Functions to call with the changes whenever the cache is refreshed
+_subscribers: list[Callable[[dict, dict], None]] = []
+
+# Patches and writes to cache.json happen one at a time
+_save_lock = threading.RLock()
+
 
 def find_all_groups(cache, config):
     groups = []
@@ -36,30 +48,53 @@ def find_groups_for_user(contact, config):
     return groups
 
 
-def format_contact(contact: dict, slack: bool = False, config={}) -> str:
+def _display_name(contact: dict) -> str:
+    # These fields are present in the API response regardless of whether the contact has a first or last name. Since the field has a value dict.get won't work as expected.
+    first_name = contact["first_name"] or "Unknown"
+    last_name = contact["last_name"] or "Unknown"
     n = ""
-    s = ""
     if contact["nick_name"]:
         n = f" ({contact['nick_name']})"
+    return f"{first_name.capitalize()} {last_name.capitalize()}{n}"
+
+
+def _slack_id(contact: dict, config: dict) -> str | None:
+    for field in contact["custom_fields"]:
+        if field["id"] == config["tidyhq"]["ids"]["slack"]:
+            if field["value"]:
+                return field["value"]
+    return None
+
+
+def decorate_contact(contact: dict, config: dict) -> None:
+    """Store the display name, Slack ID and Slack mention on a contact as it's added to the cache.
+
+    These are never modified afterwards so they're safe to read from any thread.
+    """
+    contact["display_name"] = _display_name(contact)
+    contact["slack_id"] = _slack_id(contact, config)
+    contact["slack_mention"] = (
+        f"<@{contact['slack_id']}>" if contact["slack_id"] else None
+    )
+
+
+def format_contact(contact: dict, slack: bool = False, config={}) -> str:
+    # Contacts are decorated when the cache is built, fall back to calculating on the fly for anything else
+    name = contact.get("display_name") or _display_name(contact)
 
     if slack and config:
         # Check if the user has a slack ID
-        for field in contact["custom_fields"]:
-            if field["id"] == config["tidyhq"]["ids"]["slack"]:
-                if field["value"]:
-                    s = f" <@{field['value']}>"
-                    break
+        if "slack_mention" in contact:
+            mention = contact["slack_mention"]
+        else:
+            slack_id = _slack_id(contact, config)
+            mention = f"<@{slack_id}>" if slack_id else None
+        if mention:
+            name += f" {mention}"
     elif slack and not config:
         logging.error("No config provided")
 
-    # This field is present in the API response regardless of whether the contact has a first or last name. Since the field has a value dict.get won't work as expected.
-    if not contact["first_name"]:
-        contact["first_name"] = "Unknown"
-
-    if not contact["last_name"]:
-        contact["last_name"] = "Unknown"
-
-    return f"{contact.get('first_name', 'Unknown').capitalize()} {contact.get('last_name', 'Unknown').capitalize()}{n}{s}"
+    return name
 
 
 def get_contact(contact_id, cache):
@@ -69,10 +104,7 @@ def get_contact(contact_id, cache):
         except:
             pass
 
-    for contact in cache["contacts"]:
-        if contact["id"] == contact_id:
-            return contact
-    return None
+    return index(cache=cache)["contacts"].get(contact_id)
 
 
 def query(
@@ -91,43 +123,57 @@ def query(
             if cat == "groups":
                 if term:
                     if term in cache["groups"]:
+                        metrics.cache_lookup("tidyhq", hit=True)
                         return cache["groups"][term]
                     else:
                         try:
                             if int(term) in cache["groups"]:
+                                metrics.cache_lookup("tidyhq", hit=True)
                                 return cache["groups"][int(term)]
                         except:
                             pass
                     # If we can't find the group, handle via query instead
                     logging.debug(f"Could not find group with ID {term} in cache")
                 else:
+                    metrics.cache_lookup("tidyhq", hit=True)
                     return cache["groups"]
             elif cat == "contacts":
                 if term:
-                    for contact in cache["contacts"]:
-                        if int(contact["id"]) == int(term):
-                            return contact
+                    contact = index(cache=cache)["contacts"].get(int(term))
+                    if contact:
+                        metrics.cache_lookup("tidyhq", hit=True)
+                        return contact
                     # If we can't find the contact, handle via query
                     logging.debug(f"Could not find contact with ID {term} in cache")
                 else:
+                    metrics.cache_lookup("tidyhq", hit=True)
                     return cache["contacts"]
         else:
             logging.debug(f"Could not find category {cat} in cache")
+        metrics.cache_lookup("tidyhq", hit=False)
 
     append = ""
     if term:
         append = f"/{term}"
 
     logging.debug(f"Querying TidyHQ for {cat}{append}")
-    try:
-        r = requests.get(
-            f"https://api.tidyhq.com/v1/{cat}{append}",
-            params={"access_token": config["tidyhq"]["token"]},
-        )
-        data = r.json()
-    except requests.exceptions.RequestException as e:
-        logging.error("Could not reach TidyHQ")
-        sys.exit(1)
+    # requests is only loaded once we actually need TidyHQ, cron scripts usually run from the cache
+    import requests
+
+    start = time.time()
+    with tracing.span(f"tidyhq GET {cat}", term=term):
+        try:
+            r = requests.get(
+                f"https://api.tidyhq.com/v1/{cat}{append}",
+                params={"access_token": config["tidyhq"]["token"]},
+            )
+            data = r.json()
+        except requests.exceptions.RequestException as e:
+            metrics.external_call("tidyhq", f"GET {cat}", "error", time.time() - start)
+            logging.error("Could not reach TidyHQ")
+            sys.exit(1)
+        tracing.annotate(status=r.status_code)
+    metrics.external_call("tidyhq", f"GET {cat}", r.status_code, time.time() - start)
 
     if cat == "groups" and not term:
         # Index groups by ID
@@ -194,6 +240,45 @@ def get_group_info(
     return processed
 
 
+def _trim_contact(contact: dict, config: dict) -> dict:
+    """Cut a contact from TidyHQ down to what we need and decorate it for the cache."""
+    useful_fields = [
+        "contact_id",
+        "custom_fields",
+        "first_name",
+        "groups",
+        "id",
+        "last_name",
+        "nick_name",
+        "status",
+    ]
+
+    trimmed_contact = copy(contact)
+
+    # Get rid of fields we don't need
+    for field in contact:
+        if field not in useful_fields:
+            del trimmed_contact[field]
+
+    # Get rid of groups we don't need
+    useful_groups = []
+    for group in trimmed_contact["groups"]:
+        if config["tidyhq"]["group_prefix"] in group["label"]:
+            useful_groups.append(group)
+    trimmed_contact["groups"] = useful_groups
+
+    # Get rid of custom fields we don't need
+    useful_custom_fields = []
+    for field in trimmed_contact["custom_fields"]:
+        if field["id"] in config["tidyhq"]["ids"].values():
+            useful_custom_fields.append(field)
+    trimmed_contact["custom_fields"] = useful_custom_fields
+
+    decorate_contact(contact=trimmed_contact, config=config)
+    return trimmed_contact
+
+
+@profiling.profiled("cache_refresh")
 def setup_cache(config) -> dict[str, Any]:
     cache = {}
     logging.debug("Getting contacts from TidyHQ")
@@ -206,58 +291,314 @@ def setup_cache(config) -> dict[str, Any]:
     logging.debug(f"Got {len(cache['groups'])} groups from TidyHQ")
 
     # Trim contact data to just what we need
-    cache["contacts"] = []
-    useful_fields = [
-        "contact_id",
-        "custom_fields",
-        "first_name",
-        "groups",
-        "id",
-        "last_name",
-        "nick_name",
-        "status",
+    cache["contacts"] = [
+        _trim_contact(contact=contact, config=config) for contact in raw_contacts
     ]
 
-    for contact in raw_contacts:
-        trimmed_contact = copy(contact)
-
-        # Get rid of fields we don't need
-        for field in contact:
-            if field not in useful_fields:
-                del trimmed_contact[field]
+    cache["time"] = datetime.datetime.now().timestamp()
+    save_cache(cache, config=config)
 
-        # Get rid of groups we don't need
-        useful_groups = []
-        for group in trimmed_contact["groups"]:
-            if config["tidyhq"]["group_prefix"] in group["label"]:
-                useful_groups.append(group)
-        trimmed_contact["groups"] = useful_groups
+    return cache
 
-        # Get rid of custom fields we don't need
-        useful_custom_fields = []
-        for field in trimmed_contact["custom_fields"]:
-            if field["id"] in config["tidyhq"]["ids"].values():
-                useful_custom_fields.append(field)
-        trimmed_contact["custom_fields"] = useful_custom_fields
 
-        cache["contacts"].append(trimmed_contact)
+def save_cache(cache: dict, config: dict | None = None) -> None:
+    if config and config.get("cache_store"):
+        # Other processes sharing the store, on any host, use this to tell the change wasn't theirs
+        cache["written_by"] = leader.holder_id()
+        cache["store_version"] = cachestore.write(config["cache_store"], cache)
+        return
 
     logging.debug("Writing cache to file")
-    cache["time"] = datetime.datetime.now().timestamp()
-    with open("cache.json", "w") as f:
-        json.dump(cache, f)
+    with _save_lock:
+        # Write to a temporary file first so readers and crashes never see a half written cache
+        with open(f"cache.json.{os.getpid()}.tmp", "w") as f:
+            json.dump(cache, f)
+        os.replace(f"cache.json.{os.getpid()}.tmp", "cache.json")
+
+
+def _patch(cache: dict, config: dict, patch: Callable[[dict], Any]) -> Any:
+    """Apply patch to the cache, bump its generation and save it. Returns what patch returned.
+
+    With a cache store the patch is applied to the newest stored cache in one transaction so patches made by other processes aren't lost. The cache is then brought up to date with the stored one.
+    """
+
+    def patch_and_bump(patched: dict) -> Any:
+        result = patch(patched)
+        patched["generation"] = patched.get("generation", 0) + 1
+        # Other processes sharing the store, on any host, use this to tell the change wasn't theirs
+        patched["written_by"] = leader.holder_id()
+        return result
+
+    if not config.get("cache_store"):
+        with _save_lock:
+            result = patch_and_bump(cache)
+            save_cache(cache, config=config)
+        return result
+
+    version, stored, result = cachestore.update(
+        config["cache_store"], patch=patch_and_bump, default=cache
+    )
+    stored["store_version"] = version
+    if stored is not cache:
+        # Replace each part rather than modify them since renders may be reading them
+        cache.update(stored)
+    return result
+
+
+def patch_memberships(
+    cache: dict, contact_id, changes: list[tuple[int, str]], config: dict
+) -> dict:
+    """Apply group membership changes we've already made in TidyHQ to the cache instead of refetching everything.
+
+    changes is a list of (group_id, action) where action is "add" or "remove". Subscribers are notified as if the cache had been refreshed.
+    Returns the cache to use from now on, which is only a new one if the contact wasn't in the cache and it had to be refreshed.
+    """
+    if not changes:
+        return cache
 
+    contact_id = int(contact_id)
+    if contact_id not in index(cache=cache)["contacts"]:
+        # Most likely a contact added to TidyHQ since the cache was loaded
+        logging.warning(f"Contact {contact_id} is not in the cache, refreshing it")
+        return fresh_cache(cache=cache, config=config, force=True)
+
+    added = set()
+    removed = set()
+    for group_id, action in changes:
+        if action == "add":
+            added.add(int(group_id))
+            removed.discard(int(group_id))
+        else:
+            removed.add(int(group_id))
+            added.discard(int(group_id))
+
+    def patch(patched: dict) -> None:
+        # Replace rather than modify the contacts since renders may be reading them
+        contacts = []
+        for contact in patched["contacts"]:
+            if contact["id"] == contact_id:
+                groups = [
+                    group
+                    for group in contact["groups"]
+                    if int(group["id"]) not in removed
+                ]
+                current = {int(group["id"]) for group in groups}
+                for group_id in added - current:
+                    group = patched["groups"].get(group_id) or patched["groups"].get(
+                        str(group_id)
+                    )
+                    if not group:
+                        logging.warning(
+                            f"Group {group_id} is not in the cache, skipping patch"
+                        )
+                        continue
+                    groups.append({"id": group_id, "label": group["label"]})
+                contact = {**contact, "groups": groups}
+            contacts.append(contact)
+        patched["contacts"] = contacts
+
+    _patch(cache=cache, config=config, patch=patch)
+    logging.debug(f"Patched {len(changes)} group memberships for {contact_id}")
+
+    _publish(
+        changes={
+            "contacts": {contact_id: {"added": added, "removed": removed}},
+            "groups": set(),
+        },
+        cache=cache,
+    )
     return cache
 
 
+def patch_contact(cache: dict, contact_id, contact: dict | None, config: dict) -> None:
+    """Replace a contact in the cache with a copy fetched from TidyHQ, or remove it if contact is None.
+
+    Used when TidyHQ tells us about a change (see webhooks.py). Subscribers are notified if the contact's sign offs changed.
+    """
+    contact_id = int(contact_id)
+    new = _trim_contact(contact=contact, config=config) if contact else None
+
+    def patch(patched: dict) -> dict | None:
+        # Replace rather than modify the list since renders may be reading it
+        contacts = []
+        old = None
+        for existing in patched["contacts"]:
+            if existing["id"] != contact_id:
+                contacts.append(existing)
+            elif old is None:
+                old = existing
+                if new:
+                    contacts.append(new)
+        if old is None and new:
+            contacts.append(new)
+        patched["contacts"] = contacts
+        return old
+
+    old = _patch(cache=cache, config=config, patch=patch)
+    logging.debug(f"Patched contact {contact_id} in the cache")
+
+    before = {int(group["id"]) for group in old["groups"]} if old else set()
+    after = {int(group["id"]) for group in new["groups"]} if new else set()
+    if before != after:
+        _publish(
+            changes={
+                "contacts": {
+                    contact_id: {"added": after - before, "removed": before - after}
+                },
+                "groups": set(),
+            },
+            cache=cache,
+        )
+
+
+def patch_group(cache: dict, group_id, group: dict | None, config: dict) -> None:
+    """Replace a group in the cache with a copy fetched from TidyHQ, or remove it if group is None.
+
+    Subscribers are notified if a sign off group was added, removed or changed.
+    """
+    group_id = int(group_id)
+
+    def patch(patched: dict) -> dict | None:
+        groups = dict(patched["groups"])
+        # Group keys are strings once the cache has been through JSON
+        key: int | str = group_id
+        if str(group_id) in groups or any(isinstance(k, str) for k in groups):
+            key = str(group_id)
+        old = groups.pop(key, None)
+        if group:
+            groups[key] = group
+        patched["groups"] = groups
+        return old
+
+    old = _patch(cache=cache, config=config, patch=patch)
+    logging.debug(f"Patched group {group_id} in the cache")
+
+    prefix = config["tidyhq"]["group_prefix"]
+    relevant = any(prefix in g["label"] for g in (old, group) if g)
+    changed = (
+        not old
+        or not group
+        or old["label"] != group["label"]
+        or old["description"] != group["description"]
+    )
+    if relevant and changed:
+        _publish(changes={"contacts": {}, "groups": {group_id}}, cache=cache)
+
+
+def generation(cache: dict) -> tuple:
+    """Identify a particular version of the cache so derived data can be reused until it changes."""
+    return (cache.get("time"), cache.get("generation", 0))
+
+
+def index(cache: dict, config: dict | None = None) -> dict[str, dict]:
+    """Return lookup tables of contacts by TidyHQ ID and TidyHQ IDs by Slack ID.
+
+    Tables are built once per cache generation. The Slack table needs the config to identify the Slack custom field.
+    """
+    key = (generation(cache), id(cache))
+    tables = _indexes.get(key)
+    if tables is None:
+        tables = {"contacts": {contact["id"]: contact for contact in cache["contacts"]}}
+        _indexes.clear()
+        _indexes[key] = tables
+
+    if config and "slack" not in tables:
+        # Only share the table once it's complete, other threads may be looking up Slack IDs
+        slack = {}
+        for contact in cache["contacts"]:
+            slack_id = get_slack_id(config=config, contact=contact)
+            if slack_id:
+                # Keep the first contact linked to a Slack ID, matching the old linear search
+                slack.setdefault(slack_id, contact["id"])
+        tables["slack"] = slack
+        logging.debug(f"Indexed {len(slack)} Slack linked contacts")
+
+    return tables
+
+
+def restore_index(cache: dict, tables: dict[str, dict]) -> None:
+    """Reuse lookup tables built for this cache by a previous process (see snapshot.py)."""
+    _indexes.clear()
+    _indexes[(generation(cache), id(cache))] = tables
+
+
 def translate_slack_to_tidyhq(slack_id: str, cache: dict, config: dict):
-    for contact in cache["contacts"]:
-        # Iterate over custom fields
-        for field in contact["custom_fields"]:
-            if field["id"] == config["tidyhq"]["ids"]["slack"]:
-                if field["value"] == slack_id:
-                    return contact["id"]
-    return None
+    return index(cache=cache, config=config)["slack"].get(slack_id)
+
+
+def subscribe(callback: Callable[[dict, dict], None]) -> None:
+    """Register a function to be called with (changes, cache) whenever a cache refresh changes something.
+
+    See diff_caches for the format of changes.
+    """
+    _subscribers.append(callback)
+
+
+def _publish(changes: dict, cache: dict) -> None:
+    for callback in _subscribers:
+        try:
+            callback(changes, cache)
+        except Exception:
+            logging.exception(f"Cache change subscriber {callback.__name__} failed")
+
+
+def diff_caches(old: dict, new: dict, config: dict) -> dict[str, Any]:
+    """Work out what changed between two versions of the cache.
+
+    Returns a dict with:
+    contacts: {contact_id: {"added": set of group IDs, "removed": set of group IDs}} for contacts whose sign off groups changed
+    groups: set of sign off group IDs that were added, removed, or had their label or description changed
+    """
+    prefix = config["tidyhq"]["group_prefix"]
+
+    # Group keys are strings once the cache has been through JSON
+    def sign_off_groups(cache):
+        return {
+            int(group_id): group
+            for group_id, group in cache["groups"].items()
+            if prefix in group["label"]
+        }
+
+    def memberships(cache):
+        members: dict[int, set[int]] = {}
+        for contact in cache["contacts"]:
+            members.setdefault(contact["id"], set()).update(
+                int(group["id"]) for group in contact["groups"]
+            )
+        return members
+
+    old_groups = sign_off_groups(old)
+    new_groups = sign_off_groups(new)
+    changed_groups = set()
+    for group_id in old_groups.keys() | new_groups.keys():
+        old_group = old_groups.get(group_id)
+        new_group = new_groups.get(group_id)
+        if (
+            not old_group
+            or not new_group
+            or old_group["label"] != new_group["label"]
+            or old_group["description"] != new_group["description"]
+        ):
+            changed_groups.add(group_id)
+
+    old_members = memberships(old)
+    new_members = memberships(new)
+    changed_contacts = {}
+    for contact_id in old_members.keys() | new_members.keys():
+        before = old_members.get(contact_id, set())
+        after = new_members.get(contact_id, set())
+        if before != after:
+            changed_contacts[contact_id] = {
+                "added": after - before,
+                "removed": before - after,
+            }
+
+    return {"contacts": changed_contacts, "groups": changed_groups}
+
+
+def is_stale(cache: dict, config: dict) -> bool:
+    """Check whether the cache is older than config["cache_expiry"]."""
+    return cache["time"] < datetime.datetime.now().timestamp() - config["cache_expiry"]
 
 
 def fresh_cache(cache=None, config=None, force=False) -> dict[str, Any]:
@@ -266,16 +607,44 @@ def fresh_cache(cache=None, config=None, force=False) -> dict[str, Any]:
             logging.debug("Loading config from file")
             config = json.load(f)
 
+    with tracing.span("cache", force=force):
+        new_cache = _fresh_cache(cache=cache, config=config, force=force)
+        tracing.annotate(refreshed=new_cache is not cache)
+
+    # Let subscribers know what changed if we've replaced an existing cache
+    if cache and new_cache is not cache:
+        publish_changes(old=cache, new=new_cache, config=config)
+
+    return new_cache
+
+
+def publish_changes(old: dict, new: dict, config: dict) -> bool:
+    """Tell subscribers what changed between a cache and the one replacing it. Returns whether anything did."""
+    changes = diff_caches(old=old, new=new, config=config)
+    # Changes picked up from the cache store have already been acted on by the process that made them
+    changes["remote"] = new.get("written_by", leader.holder_id()) != leader.holder_id()
+    if changes["contacts"] or changes["groups"]:
+        logging.debug(
+            f"Cache refresh changed {len(changes['contacts'])} contacts and {len(changes['groups'])} groups"
+        )
+        _publish(changes=changes, cache=new)
+        return True
+    return False
+
+
+def _fresh_cache(cache, config, force) -> dict[str, Any]:
+    if config.get("cache_store"):
+        return _fresh_store_cache(cache=cache, config=config, force=force)
+
     if cache:
         # Check if the cache we've been provided with is fresh
-        if (
-            cache["time"] < datetime.datetime.now().timestamp() - config["cache_expiry"]
-            or force
-        ):
+        if is_stale(cache=cache, config=config) or force:
             logging.debug("Provided cache is stale")
         else:
             # If the provided cache is fresh, just return it
+            metrics.cache_lookup("tidyhq_memory", hit=True)
             return cache
+    metrics.cache_lookup("tidyhq_memory", hit=False)
 
     # If we haven't been provided with a cache, or the provided cache is stale, try loading from file
     try:
@@ -290,11 +659,13 @@ def fresh_cache(cache=None, config=None, force=False) -> dict[str, Any]:
         cache = setup_cache(config=config)
         return cache
 
+    # Cache files written before contacts were decorated need it done on load
+    for contact in cache["contacts"]:
+        if "display_name" not in contact:
+            decorate_contact(contact=contact, config=config)
+
     # If the cache file is also stale, refresh it
-    if (
-        cache["time"] < datetime.datetime.now().timestamp() - config["cache_expiry"]
-        or force
-    ):
+    if is_stale(cache=cache, config=config) or force:
         logging.debug("Cache file is stale")
         cache = setup_cache(config=config)
         return cache
@@ -303,6 +674,46 @@ def fresh_cache(cache=None, config=None, force=False) -> dict[str, Any]:
         return cache
 
 
+def _fresh_store_cache(cache, config, force) -> dict[str, Any]:
+    """Get a fresh cache from the store shared with other processes.
+
+    Only one process refreshes from TidyHQ at a time, the others keep using the cache they have until the refresh is stored.
+    """
+    path = config["cache_store"]
+    stored_version = cachestore.version(path)
+
+    # Pick up refreshes and patches made by other processes
+    if stored_version and (not cache or cache.get("store_version") != stored_version):
+        stored_version, cache = cachestore.read(path)
+        cache["store_version"] = stored_version  # type: ignore
+        logging.debug(f"Loaded cache version {stored_version} from the store")
+
+    if cache and not (is_stale(cache=cache, config=config) or force):
+        metrics.cache_lookup("tidyhq_memory", hit=True)
+        return cache
+    metrics.cache_lookup("tidyhq_memory", hit=False)
+
+    # With leader election only the leader refreshes on its own (see slack.py), the rest wait for it to store the refresh
+    if cache and not force and not leader.is_leader():
+        logging.debug("Leaving the cache refresh to the leader")
+        return cache
+
+    # With nothing to fall back on we have to wait for whoever is refreshing
+    with cachestore.refresh_lock(path, wait=not cache) as acquired:
+        if not acquired:
+            logging.debug("Another process is refreshing the cache")
+            return cache
+
+        # A refresh may have been stored while we were waiting for the lock
+        if cachestore.version(path) != stored_version:
+            stored_version, stored = cachestore.read(path)
+            if stored and not (is_stale(cache=stored, config=config) or force):
+                stored["store_version"] = stored_version
+                return stored
+
+        return setup_cache(config=config)
+
+
 def is_member(contact):
     pass
 
@@ -314,10 +725,8 @@ def list_all(cache, config, filters: list = ["slack"]):
     contacts = []
     for contact in cache["contacts"]:
         if "slack" in filters:
-            # Iterate over custom fields
-            for field in contact["custom_fields"]:
-                if field["id"] == config["tidyhq"]["ids"]["slack"]:
-                    contacts.append(contact["id"])
+            if get_slack_id(config=config, contact=contact):
+                contacts.append(contact["id"])
         else:
             contacts.append(contact["id"])
 
@@ -332,17 +741,31 @@ def update_group_membership(tidyhq_id, group_id, action, config):
         logging.error("Action must be either 'add' or 'remove'")
         return False
 
-    if action == "add":
-        r = requests.put(
-            f"https://api.tidyhq.com/v1/groups/{group_id}/contacts/{tidyhq_id}",
-            params={"access_token": config["tidyhq"]["token"]},
-        )
+    import requests
 
-    else:
-        r = requests.delete(
-            f"https://api.tidyhq.com/v1/groups/{group_id}/contacts/{tidyhq_id}",
-            params={"access_token": config["tidyhq"]["token"]},
-        )
+    start = time.time()
+    with tracing.span(
+        f"tidyhq {action} group membership", group=group_id, contact=tidyhq_id
+    ):
+        if action == "add":
+            r = requests.put(
+                f"https://api.tidyhq.com/v1/groups/{group_id}/contacts/{tidyhq_id}",
+                params={"access_token": config["tidyhq"]["token"]},
+            )
+
+        else:
+            r = requests.delete(
+                f"https://api.tidyhq.com/v1/groups/{group_id}/contacts/{tidyhq_id}",
+                params={"access_token": config["tidyhq"]["token"]},
+            )
+        tracing.annotate(status=r.status_code)
+
+    metrics.external_call(
+        "tidyhq",
+        "PUT groups/contacts" if action == "add" else "DELETE groups/contacts",
+        r.status_code,
+        time.time() - start,
+    )
 
     if r.status_code == 204:  # Success
         return True
@@ -360,7 +783,6 @@ def get_slack_id(config, contact=None, id=None, cache=None):
         if not contact:
             return None
 
-    for field in contact["custom_fields"]:
-        if field["id"] == config["tidyhq"]["ids"]["slack"]:
-            return field["value"]
-    return None
+    if "slack_id" in contact:
+        return contact["slack_id"]
+    return _slack_id(contact, config)
@@ -0,0 +1,119 @@
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+# Set up logging
+logger = logging.getLogger("tracing")
+
+# Spans are written here as JSON lines when tracing is enabled
+trace_file: str | None = None
+
+# Fraction of incoming payloads that are traced
+sample_rate = 1.0
+
+# The span work is currently running in. Worker tasks inherit it (see workers.submit)
+_current: contextvars.ContextVar[dict | None] = contextvars.ContextVar(
+    "span", default=None
+)
+
+_spans: queue.Queue = queue.Queue()
+_writer: threading.Thread | None = None
+
+
+def configure(config: dict) -> None:
+    """Enable tracing if config["trace_file"] is set."""
+    global trace_file, sample_rate, _writer
+    trace_file = config.get("trace_file")
+    sample_rate = config.get("trace_sample_rate", 1.0)
+    if trace_file and not _writer:
+        _writer = threading.Thread(target=_write, name="tracing", daemon=True)
+        _writer.start()
+        logger.info(f"Writing traces to {trace_file}")
+
+
+def _write() -> None:
+    while True:
+        spans = [_spans.get()]
+        # Write whatever else has finished in the meantime in one go
+        while not _spans.empty():
+            spans.append(_spans.get())
+        try:
+            with open(trace_file, "a") as f:  # type: ignore
+                for span in spans:
+                    f.write(json.dumps(span) + "\n")
+        except OSError:
+            logger.exception(f"Could not write traces to {trace_file}")
+
+
+def _new_id() -> str:
+    return os.urandom(8).hex()
+
+
+@contextmanager
+def _run(span: dict) -> Iterator[dict]:
+    token = _current.set(span)
+    start = time.time()
+    try:
+        yield span
+    except Exception as e:
+        span["status"] = "error"
+        span["attributes"]["error"] = repr(e)
+        raise
+    finally:
+        _current.reset(token)
+        span["start"] = start
+        span["duration"] = time.time() - start
+        _spans.put(span)
+
+
+@contextmanager
+def trace(name: str, **attributes) -> Iterator[dict | None]:
+    """Start a new trace, typically for one incoming Slack payload."""
+    if not trace_file or random.random() >= sample_rate:
+        yield None
+        return
+    span = {
+        "trace_id": os.urandom(16).hex(),
+        "span_id": _new_id(),
+        "parent_id": None,
+        "name": name,
+        "thread": threading.current_thread().name,
+        "status": "ok",
+        "attributes": attributes,
+    }
+    with _run(span) as span:
+        yield span
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[dict | None]:
+    """Record a span within the current trace. Outside of a trace this does nothing."""
+    parent = _current.get()
+    if not parent:
+        yield None
+        return
+    child = {
+        "trace_id": parent["trace_id"],
+        "span_id": _new_id(),
+        "parent_id": parent["span_id"],
+        "name": name,
+        "thread": threading.current_thread().name,
+        "status": "ok",
+        "attributes": attributes,
+    }
+    with _run(child) as child:
+        yield child
+
+
+def annotate(**attributes) -> None:
+    """Add attributes to the current span, if there is one."""
+    current = _current.get()
+    if current:
+        current["attributes"].update(attributes)
@@ -0,0 +1,129 @@
+import hmac
+import json
+import logging
+import threading
+import time
+from typing import Callable
+from urllib.parse import parse_qs, urlparse
+
+from . import metrics, tidyhq
+
+# Set up logging
+logger = logging.getLogger("webhooks")
+
+# Receives TidyHQ webhooks so changes made directly in TidyHQ reach the cache without waiting for it to expire
+# Events are expected to look like {"kind": "contact.updated", "data": {...}}
+# The contact or group is always fetched from TidyHQ again rather than taken from the payload,
+# so repeated, retried or out of order events always leave the cache matching TidyHQ
+
+# Patches replace the cache's contact list and group dict, one at a time
+_lock = threading.Lock()
+
+
+def _contact_id(kind: str, data: dict):
+    """The contact an event is about, including group membership events."""
+    if kind.startswith("contact."):
+        return data.get("id")
+    return data.get("contact_id") or (data.get("contact") or {}).get("id")
+
+
+def apply(event: dict, cache: dict, config: dict) -> str:
+    """Patch the cache with a webhook event. Returns what was patched for logging and metrics."""
+    kind = event.get("kind", "")
+    data = event.get("data") or {}
+
+    contact_id = _contact_id(kind, data)
+    if contact_id:
+        if kind.startswith("contact.") and kind.endswith("deleted"):
+            contact = None
+        else:
+            contact = tidyhq.query(cat="contacts", term=contact_id, config=config)
+            if not isinstance(contact, dict) or "id" not in contact:
+                logger.warning(f"Could not fetch contact {contact_id} for {kind}")
+                return "failed"
+        with _lock:
+            tidyhq.patch_contact(
+                cache=cache, contact_id=contact_id, contact=contact, config=config
+            )
+        return "contact"
+
+    if kind.startswith("group.") and data.get("id"):
+        if kind.endswith("deleted"):
+            group = None
+        else:
+            group = tidyhq.query(cat="groups", term=data["id"], config=config)
+            if not isinstance(group, dict) or "id" not in group:
+                logger.warning(f"Could not fetch group {data['id']} for {kind}")
+                return "failed"
+        with _lock:
+            tidyhq.patch_group(
+                cache=cache, group_id=data["id"], group=group, config=config
+            )
+        return "group"
+
+    return "ignored"
+
+
+def serve(
+    port: int, config: dict, get_cache: Callable[[], dict], host: str = "127.0.0.1"
+):
+    """Receive TidyHQ webhooks at /tidyhq on a background thread.
+
+    get_cache returns the cache currently in use. Requests must include ?token=config["tidyhq_webhook_secret"] if it's set.
+    """
+    # Only long running processes receive webhooks (see metrics.serve)
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    secret = config.get("tidyhq_webhook_secret")
+    record = config.get("tidyhq_webhook_record")
+    record_lock = threading.Lock()
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != "/tidyhq":
+                self.send_error(404)
+                return
+            token = parse_qs(url.query).get("token", [""])[0]
+            if secret and not hmac.compare_digest(token, secret):
+                metrics.inc("tidyhq_webhooks_total", result="unauthorised")
+                self.send_error(401)
+                return
+
+            try:
+                event = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            except (TypeError, ValueError):
+                metrics.inc("tidyhq_webhooks_total", result="invalid")
+                self.send_error(400)
+                return
+
+            if record:
+                # Recorded events can be sent again with webhook_replay.py
+                with record_lock, open(record, "a") as f:
+                    f.write(
+                        json.dumps({"received": time.time(), "event": event}) + "\n"
+                    )
+
+            start = time.time()
+            try:
+                result = apply(event=event, cache=get_cache(), config=config)
+            except (Exception, SystemExit):
+                # tidyhq.query exits if TidyHQ can't be reached, a failed response makes TidyHQ send the event again
+                logger.exception(f"Could not apply {event.get('kind')} webhook")
+                result = "failed"
+            metrics.inc("tidyhq_webhooks_total", result=result)
+            logger.info(
+                f"{event.get('kind')} webhook: {result} in {time.time() - start:.2f}s"
+            )
+
+            self.send_response(500 if result == "failed" else 200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), WebhookHandler)
+    threading.Thread(target=server.serve_forever, name="webhooks", daemon=True).start()
+    logger.info(f"Receiving TidyHQ webhooks on http://{host}:{port}/tidyhq")
+    return server
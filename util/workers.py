@@ -0,0 +1,87 @@
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+from . import metrics, profiling, tracing
+
+# Set up logging
+logger = logging.getLogger("workers")
+
+# Pool for slow handler work (rendering, TidyHQ calls) so Bolt listener threads are freed up quickly
+_executor: ThreadPoolExecutor | None = None
+_size = 0
+_stats = {"queued": 0, "running": 0, "completed": 0, "failed": 0}
+_stats_lock = threading.Lock()
+
+
+def start(size: int) -> None:
+    """Start the worker pool. With a size of 0 work is run inline in the calling thread."""
+    global _executor, _size
+    if size > 0:
+        _executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="worker")
+        _size = size
+        logger.info(f"Started worker pool with {size} threads")
+
+
+def _run(name: str, queued_at: float, fn: Callable, args, kwargs) -> Any:
+    with _stats_lock:
+        _stats["queued"] -= 1
+        _stats["running"] += 1
+    started = time.time()
+    waited = started - queued_at
+    metrics.observe("worker_wait_seconds", waited, task=name)
+    if waited > 1:
+        logger.warning(f"{name} waited {waited:.1f}s for a worker")
+
+    try:
+        with tracing.span(f"worker {name}", waited=round(waited, 3)):
+            result = profiling.call(name, fn, *args, **kwargs)
+    except Exception:
+        with _stats_lock:
+            _stats["failed"] += 1
+        logger.exception(f"{name} failed")
+        raise
+    else:
+        with _stats_lock:
+            _stats["completed"] += 1
+        return result
+    finally:
+        metrics.observe("worker_task_seconds", time.time() - started, task=name)
+        with _stats_lock:
+            _stats["running"] -= 1
+
+
+def submit(name: str, fn: Callable, *args, **kwargs) -> Future:
+    """Run fn(*args, **kwargs) on the worker pool, or inline if the pool hasn't been started."""
+    with _stats_lock:
+        _stats["queued"] += 1
+        queued = _stats["queued"]
+        running = _stats["running"]
+
+    if not _executor:
+        future: Future = Future()
+        try:
+            future.set_result(_run(name, time.time(), fn, args, kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    logger.debug(f"Queued {name} ({queued} queued, {running}/{_size} running)")
+    if queued > _size:
+        logger.warning(f"Worker queue depth is {queued} with {_size} workers")
+    # Carry the current trace over to the worker thread
+    context = contextvars.copy_context()
+    return _executor.submit(context.run, _run, name, time.time(), fn, args, kwargs)
+
+
+def enabled() -> bool:
+    return _executor is not None
+
+
+def stats() -> dict[str, int]:
+    """Current queue depth, running tasks, and totals since startup."""
+    with _stats_lock:
+        return dict(_stats, size=_size)
@@ -0,0 +1,71 @@
+# Send recorded TidyHQ webhook events to the bot's webhook receiver, to test cache patching without changing anything in TidyHQ
+#
+# 1. Record real events by setting tidyhq_webhook_record (eg webhooks.jsonl) in config.json while the bot is running
+# 2. Replay them: ./webhook_replay.py webhooks.jsonl --url http://127.0.0.1:8090/tidyhq
+#
+# Events are sent in the order they were received. Use --realtime to keep the original gaps between them.
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+import requests
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("webhook_replay")
+
+
+def load(path: str) -> list[dict]:
+    recorded = []
+    with open(path) as f:
+        for line in f:
+            try:
+                recorded.append(json.loads(line))
+            except json.decoder.JSONDecodeError:
+                continue
+    return recorded
+
+
+def replay(recorded: list[dict], url: str, token: str | None, realtime: bool) -> int:
+    """Send each recorded event, returning how many weren't accepted."""
+    failed = 0
+    previous = None
+    for entry in recorded:
+        if realtime and previous is not None:
+            time.sleep(max(0, entry["received"] - previous))
+        previous = entry["received"]
+
+        start = time.time()
+        r = requests.post(
+            url, params={"token": token} if token else None, json=entry["event"]
+        )
+        logger.info(
+            f"{entry['event'].get('kind')}: {r.status_code} in {time.time() - start:.2f}s"
+        )
+        if r.status_code != 200:
+            failed += 1
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file", help="Events recorded by the webhook receiver")
+    parser.add_argument("--url", default="http://127.0.0.1:8090/tidyhq")
+    parser.add_argument("--realtime", action="store_true")
+    args = parser.parse_args()
+
+    with open("config.json") as f:
+        config = json.load(f)
+
+    recorded = load(args.file)
+    failed = replay(
+        recorded=recorded,
+        url=args.url,
+        token=config.get("tidyhq_webhook_secret"),
+        realtime=args.realtime,
+    )
+    print(f"Replayed {len(recorded)} events, {failed} failed")
+    sys.exit(1 if failed else 0)
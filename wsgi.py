@@ -0,0 +1,19 @@
+# Run the Slack bot in HTTP mode behind a multi-process WSGI server, eg
+# gunicorn --workers 4 --bind 0.0.0.0:3000 wsgi:app
+# Don't use --preload, each worker needs its own background threads
+# Point the Slack app's request URLs at /slack/events and set slack.signing_secret and cache_store in config.json
+
+import logging
+
+from slack_bolt.adapter.wsgi import SlackRequestHandler
+
+import slack
+
+if not slack.config.get("cache_store"):
+    logging.warning(
+        "cache_store is not set, each worker will refresh and keep its own copy of the cache"
+    )
+
+slack.start_background(http=True)
+
+app = SlackRequestHandler(slack.app)